@@ -1,4 +1,9 @@
 import logging
+import math
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from copy import deepcopy
 import numpy as np
 from tqdm import tqdm
@@ -6,61 +11,90 @@ from tqdm import tqdm
 import jax
 import jax.numpy as jnp
 from jax.scipy.special import logsumexp
-import einops
+from jax.scipy.linalg import expm
 
 import cigartree
 import likelihood
-import h20
-import km03
 from optimize import optimize, optimize_generic
 
+# Greedily partition the (nonduplicate) leaves into pairs, preferring closer pairs.
+# Rather than enumerating all O(L^2) leaf pairs, track the nearest available leaf below each node:
+# the closest available pair is always formed by the two nearest leaves in different child subtrees of their MRCA,
+# so a heap of these per-node candidates yields pairs in order, and removing a leaf only updates its ancestors.
 def pickCherries (parentIndex, distanceToParent):
     assert len(parentIndex) == len(distanceToParent), "Parent index and distance to parent must have the same length"
+    parentIndex = np.asarray (parentIndex).tolist()  # iterating over a device array element-by-element is very slow
+    distanceToParent = np.asarray (distanceToParent, dtype=float).tolist()
     assert sum(1 for n,p in enumerate(parentIndex) if p > n) == 0, "Parent index must be sorted in preorder"
     assert list(n for n,p in enumerate(parentIndex) if p < 0) == [0], "There must be exactly one root node"
     assert sum(1 for d in distanceToParent if d < 0) == 0, "All distances must be nonnegative"
     # find leaves
     nodes = len(parentIndex)
-    nChildren = [0] * nodes
-    for parent in parentIndex:
-        if parent >= 0:
-            nChildren[parent] += 1  # padding nodes with parentIndex[n]=n will be flagged as having one child here, and so excluded from leaves, which is what we want
-    leaves = [i for i,n in enumerate(nChildren) if n == 0]
-    # for each pair of leaves, find MRCA and thereby distance between leaves
-    available = [True] * nodes
-    def leafPairs():
-        for ni,i in enumerate(leaves):
-            if available[i]:
-                for j in leaves[ni+1:]:
-                    if available[j]:
-                        ia, ja, = i, j
-                        dij = 0
-                        while ia != ja:
-                            if ia > ja:
-                                dij += distanceToParent[ia]
-                                ia = parentIndex[ia]
-                            else:
-                                dij += distanceToParent[ja]
-                                ja = parentIndex[ja]
-                        if dij > 0:  # avoid zero-length branches
-                            yield (i,j), dij
-                        else:
-                            available[j] = False  # remove duplicates
-    lp = sorted(leafPairs(), key=lambda x: x[1])
-    # return a unique partition of nonduplicate leaves into pairs with their distances, preferring closer pairs
-    def cherryPairs():
-        for (i,j), dij in lp:
-            if available[i] and available[j]:
-                available[i] = False
-                available[j] = False
-                yield (i,j), dij
-    return cherryPairs()
+    children = [[] for _ in range(nodes)]
+    for n, parent in enumerate(parentIndex):
+        if parent >= 0 and parent != n:  # padding nodes with parentIndex[n]=n are attached to nothing and have no leaf descendants
+            children[parent].append(n)
+    isPadding = [parent == n for n, parent in enumerate(parentIndex)]
+    leaves = [n for n in range(nodes) if len(children[n]) == 0 and not isPadding[n]]
+    # depth of each node, and the highest ancestor reachable by zero-length branches (leaves sharing this are duplicates)
+    depth = [0.] * nodes
+    top = list(range(nodes))
+    for n in range(1, nodes):
+        if not isPadding[n]:
+            depth[n] = depth[parentIndex[n]] + distanceToParent[n]
+            if distanceToParent[n] == 0:
+                top[n] = top[parentIndex[n]]
+    # remove duplicates (leaves at zero distance from an earlier leaf)
+    available = [False] * nodes
+    seenTop = set()
+    for n in leaves:
+        if top[n] not in seenTop:
+            seenTop.add(top[n])
+            available[n] = True
+    # nearest[n] = (depth, index) of the nearest available leaf descended from n, or None
+    nearest = [None] * nodes
+    candidate = [None] * nodes
+    heap = []
+    def updateNode (n):
+        if len(children[n]) == 0:
+            nearest[n] = (depth[n], n) if available[n] else None
+            return
+        best = sorted (nearest[c] for c in children[n] if nearest[c] is not None)[:2]
+        nearest[n] = best[0] if len(best) > 0 else None
+        if len(best) == 2:
+            (di, i), (dj, j) = best
+            dij = (di - depth[n]) + (dj - depth[n])
+            pair = (dij, min(i,j), max(i,j))
+            if pair != candidate[n]:
+                candidate[n] = pair
+                heapq.heappush (heap, pair)
+        else:
+            candidate[n] = None
+    for n in range(nodes-1, -1, -1):
+        if not isPadding[n]:
+            updateNode (n)
+    # repeatedly take the closest available pair, then update the ancestors of the removed leaves
+    cherries = []
+    while len(heap) > 0:
+        dij, i, j = heapq.heappop (heap)
+        if available[i] and available[j]:
+            cherries.append (((i,j), dij))
+            for leaf in (i, j):
+                available[leaf] = False
+                n = leaf
+                while n >= 0:
+                    oldNearest = nearest[n]
+                    updateNode (n)
+                    if n != leaf and nearest[n] == oldNearest:
+                        break
+                    n = parentIndex[n]
+    return cherries
 
 def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False):
     seqs, parentIndex, distanceToParent, transCounts = data
     subRate, rootProb, indelParams, alnTypeWeight, colTypeWeight, colQuantiles = model
     alphabetSize = subRate.shape[-1]
-    logQuantiles = jnp.log(len(colQuantiles))
+    logQuantiles = math.log(len(colQuantiles))  # = -log P(quantile), as a Python constant
     colTypeLogWeight = jnp.log(colTypeWeight)
     alnTypeLogWeight = jnp.log(alnTypeWeight)
     colMask = jnp.where(jnp.all(seqs < 0, axis=0), 0, 1)  # (nCols,)
@@ -69,7 +103,8 @@ def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False):
     atc_ll = logsumexp(aqtc_ll,axis=1)  # (nAlignTypes, nColTypes, nCols)
     at_ll = jnp.einsum('atc->at', atc_ll)  # (nAlignTypes, nColTypes)
     a_ll = logsumexp(at_ll,axis=-1)  # (nAlignTypes,)
-    a_ll += jnp.array ([jnp.sum (likelihood.transLogLike (transCounts, distanceToParent, p, alphabetSize=alphabetSize, useKM03=useKM03)) for p in indelParams])  # (nAlignTypes,)
+    transLogLikeForParams = lambda p: jnp.sum (likelihood.transLogLike (transCounts, distanceToParent, p, alphabetSize=alphabetSize, useKM03=useKM03))
+    a_ll += jax.vmap (transLogLikeForParams) (indelParams)  # (nAlignTypes,)
     a_ll += alnTypeLogWeight  # (nAlignTypes,)
     ll = jnp.sum(a_ll)
     a_pp = jax.nn.softmax(a_ll)  # (nAlignTypes,)
@@ -81,91 +116,140 @@ def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False):
 
 defaultLogBase = 10**.1
 def discretizeTime (t, logBase=defaultLogBase):
-    return jnp.round (jnp.log(t) / jnp.log(logBase))
+    if isinstance (t, jax.Array):
+        return jnp.round (jnp.log(t) / jnp.log(logBase))
+    return np.round (np.log(t) / np.log(logBase))  # host-side floats & arrays: no device round-trip
 
 def undiscretizeTime (t, logBase=defaultLogBase):
     return jnp.power (logBase, t)
 
-def countWeightedCherries (data, alphabetSize, a_pp = None, qtc_pp = None, rootCount=None, count_by_t=None, logBase=defaultLogBase):
+# Select cherries and tabulate their pairwise indel transitions; these depend only on the data, so can be computed once
+# Returns (I, J, dts, pairTransCount) where I,J are (nCherries,) leaf indices, dts are (nCherries,) discretized times,
+# and pairTransCount is (nCherries,3,3) symmetrized pairwise transition counts
+def prepareCherries (data, logBase=defaultLogBase):
     seqs, parentIndex, distanceToParent, _transCounts = data
-    _nRows, nCols = seqs.shape
-    if a_pp is not None:
-        nAlignTypes = len(a_pp)
-    else:
-        nAlignTypes = 1
-        a_pp = jnp.ones (nAlignTypes)
-    if qtc_pp is not None:
-        nQuantiles, nColTypes, _ = qtc_pp.shape
-    else:
-        nQuantiles = 1
-        nColTypes = 1
-        qtc_pp = jnp.ones ((nQuantiles, nColTypes, nCols))
-    if rootCount is None:
-        rootCount = np.zeros ((nQuantiles, nColTypes, alphabetSize))
-    if count_by_t is None:
-        count_by_t = {}  # count_by_t[discretizedTime] = (subRateCount, transCounts)
-    for (i,j), dij in pickCherries (parentIndex, distanceToParent):
-        t = discretizeTime (dij, logBase=logBase).item()
-        subRateCount, transCount = count_by_t.get(t, (np.zeros((nQuantiles, nColTypes, alphabetSize, alphabetSize)),
-                                                        np.zeros((nAlignTypes, 3, 3))))
+    seqs = np.asarray (seqs)
+    cherries = list (pickCherries (parentIndex, distanceToParent))
+    I = np.array ([i for (i,_j), _dij in cherries], dtype=np.int32)
+    J = np.array ([j for (_i,j), _dij in cherries], dtype=np.int32)
+    dts = discretizeTime (np.array ([dij for _ij, dij in cherries], dtype=float), logBase=logBase)
+    pairTransCount = cigartree.countTransitionsInTokenizedPairwiseAlignments (seqs[I], seqs[J]).astype (np.float32)  # (nCherries,3,3)
+    pairTransCount = (pairTransCount + pairTransCount.swapaxes(-1,-2)) / 2
+    return I, J, dts, pairTransCount
 
-        _pairGapSize, pairTransCount = cigartree.countGapSizesInTokenizedPairwiseAlignment (seqs[i,:], seqs[j,:])
-        pairTransCount = (pairTransCount + pairTransCount.transpose()) / 2
-        for a in range(nAlignTypes):
-            transCount[a,:,:] += pairTransCount * a_pp[a]
+# Select cherries for every alignment in the dataset. This is host-side Python work, independent between alignments,
+# so with n_jobs > 1 it is farmed out to a pool of worker processes (spawned rather than forked, since JAX is multithreaded)
+def prepareDatasetCherries (dataset, logBase=defaultLogBase, n_jobs=1):
+    prepare = partial (prepareCherries, logBase=logBase)
+    if n_jobs > 1:
+        hostDataset = [(np.asarray(seqs), np.asarray(parentIndex), np.asarray(distanceToParent), None) for seqs, parentIndex, distanceToParent, _transCounts in dataset]
+        with ProcessPoolExecutor (max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return list (tqdm (executor.map (prepare, hostDataset), total=len(hostDataset)))
+    return [prepare (data) for data in tqdm(dataset)]
 
-        for col in range(nCols):
-            ci = seqs[i,col]
-            cj = seqs[j,col]
-            if ci >= 0 or cj >= 0:
-                for quantile in range(nQuantiles):
-                    for colType in range(nColTypes):
-                        count = qtc_pp[quantile,colType,col] / 2
-                        if ci >= 0:
-                            rootCount[quantile,colType,ci] += count
-                        if cj >= 0:
-                            rootCount[quantile,colType,cj] += count
-                        if ci >= 0 and cj >= 0:
-                            subRateCount[quantile,colType,ci,cj] += count
-                            subRateCount[quantile,colType,cj,ci] += count
-        
-        count_by_t[t] = subRateCount, transCount
+# Accumulate posterior-weighted counts over all cherries of one alignment, as a single (jittable) computation
+# Returns rootCount (nQuantiles, nColTypes, alphabetSize), subRateCount (nBuckets, nQuantiles, nColTypes, alphabetSize, alphabetSize),
+# and transCount (nBuckets, nAlignTypes, 3, 3), where bucket[n] is the time bucket for cherry n
+def accumulateCherryCounts (seqs, qtc_pp, a_pp, I, J, pairTransCount, bucket, nBuckets, alphabetSize):
+    w = qtc_pp / 2  # (nQuantiles, nColTypes, nCols)
+    ci = jax.nn.one_hot (seqs[I], alphabetSize)  # (nCherries, nCols, alphabetSize). Gaps (-1) map to all-zero rows
+    cj = jax.nn.one_hot (seqs[J], alphabetSize)  # (nCherries, nCols, alphabetSize)
+    valid = jnp.where (bucket < nBuckets, 1., 0.)  # (nCherries,). Padding cherries (bucket index nBuckets) contribute no root counts
+    rootCount = jnp.einsum ('qtc,pca,p->qta', w, ci + cj, valid)
+    pairSubCount = jnp.einsum ('qtc,pci,pcj->pqtij', w, ci, cj)  # (nCherries, nQuantiles, nColTypes, alphabetSize, alphabetSize)
+    subRateCount = jax.ops.segment_sum (pairSubCount + pairSubCount.swapaxes(-1,-2), bucket, num_segments=nBuckets)
+    transCount = jnp.einsum ('a,bij->baij', a_pp, jax.ops.segment_sum (pairTransCount, bucket, num_segments=nBuckets))
+    return rootCount, subRateCount, transCount
 
-    return rootCount, count_by_t
+# Assign each cherry's discretized time to a bucket shared across the whole dataset
+# Returns (dts, buckets) where dts is the sorted (nBuckets,) array of distinct discretized times, and buckets[n] is the (nCherries,) bucket index array for alignment n
+def bucketCherryTimes (cherries):
+    allDts = np.concatenate ([dts for _I, _J, dts, _pairTransCount in cherries])
+    dts, allBuckets = np.unique (allDts, return_inverse=True)
+    buckets = np.split (allBuckets, np.cumsum ([len(I) for I, *_rest in cherries])[:-1])
+    return dts, buckets
 
-def cherryCountsToArrays (count_by_t):
-    dts = sorted(count_by_t.keys())
-    ts = undiscretizeTime (np.array (dts))  # (nDiscretizedTimes,)
-    subRateCount = np.stack ([count_by_t[dt][0] for dt in dts], axis=0)  # (nDiscretizedTimes, nQuantiles, nColTypes, alphabetSize, alphabetSize)
-    transCount = np.stack ([count_by_t[dt][1] for dt in dts], axis=0)  # (nDiscretizedTimes, nAlignTypes, 3, 3)
-    return ts, subRateCount, transCount
+# Returns rootCount (nQuantiles, nColTypes, alphabetSize), subRateCount (nBuckets, nQuantiles, nColTypes, alphabetSize, alphabetSize), and transCount (nBuckets, nAlignTypes, 3, 3)
+def countWeightedCherries (data, alphabetSize, cherries, bucket, nBuckets, a_pp = None, qtc_pp = None, accumulateCherryCounts=accumulateCherryCounts):
+    seqs, _parentIndex, _distanceToParent, _transCounts = data
+    _nRows, nCols = seqs.shape
+    if a_pp is None:
+        a_pp = jnp.ones (1)
+    if qtc_pp is None:
+        qtc_pp = jnp.ones ((1, 1, nCols))
+    I, J, _dts, pairTransCount = cherries
+    rootCount, subRateCount, transCount = accumulateCherryCounts (seqs, qtc_pp, a_pp, I, J, pairTransCount, bucket, nBuckets=nBuckets, alphabetSize=alphabetSize)
+    return np.asarray (rootCount), np.asarray (subRateCount), np.asarray (transCount)
 
-def getDatasetCounts (dataset, alphabetSize, logBase=defaultLogBase):
+# Returns (ts, datasetCounts) where ts is (nBuckets,), and datasetCounts[n] = (rootCount, bucketIdx, ts[bucketIdx], subRateCount, transCount) for alignment n,
+# with counts only for the buckets bucketIdx actually used by that alignment
+def getDatasetCounts (dataset, alphabetSize, logBase=defaultLogBase, n_jobs=1):
     logging.warning("Preprocessing alignment dataset")
-    for data in tqdm(dataset):
-        rootCount, count_by_t = countWeightedCherries (data, alphabetSize, logBase=logBase)
-        ts, subRateCount, transCount = cherryCountsToArrays (count_by_t)
-        yield rootCount, count_by_t, ts, subRateCount, transCount
+    cherries = prepareDatasetCherries (dataset, logBase=logBase, n_jobs=n_jobs)
+    dts, buckets = bucketCherryTimes (cherries)
+    ts = undiscretizeTime (dts, logBase=logBase)  # (nBuckets,)
+    datasetCounts = []
+    for data, dataCherries, bucket in zip(dataset, cherries, buckets):
+        bucketIdx, localBucket = np.unique (bucket, return_inverse=True)
+        rootCount, subRateCount, transCount = countWeightedCherries (data, alphabetSize, dataCherries, localBucket, len(bucketIdx))
+        datasetCounts.append ((rootCount, bucketIdx, ts[bucketIdx], subRateCount, transCount))
+    return ts, datasetCounts
 
-def getPosteriorCounts (dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights, logBase=defaultLogBase, **kwargs):
-    model = model_factory (params)
+# Group alignments (and their cherries) by padded shape, stacking each group along a new leading axis so it can be scanned on-device.
+# Cherries are padded to a common number per group, with bucket index nBuckets, which segment_sum drops (and accumulateCherryCounts masks out of rootCount)
+def stackDatasetByShape (dataset, cherries, buckets, nBuckets):
+    itemsByShape = {}
+    for data, dataCherries, bucket in zip(dataset, cherries, buckets):
+        itemsByShape.setdefault (data[0].shape, []).append ((data, dataCherries, bucket))
+    groups = []
+    for items in itemsByShape.values():
+        nCherries = max (len(bucket) for _data, _cherries, bucket in items)
+        pad = lambda x, value=0: np.pad (x, [(0, nCherries - len(x))] + [(0,0)] * (x.ndim - 1), constant_values=value)
+        stackedData = tuple (jnp.stack (field) for field in zip (*[data for data, _cherries, _bucket in items]))
+        stackedCherries = tuple (jnp.asarray (np.stack (field)) for field in zip (*[(pad(I), pad(J), pad(pairTransCount), pad(bucket,nBuckets))
+                                                                       for _data, (I, J, _dts, pairTransCount), bucket in items]))
+        groups.append ((stackedData, stackedCherries))
+    return groups
+
+# Accumulate posterior weights and cherry counts over a group of same-shaped alignments with a single on-device scan
+# Returns (a_count, at_count, rootCount, subRateCount, transCount, ll) summed over the group
+def scanPosteriorCounts (group, model, nBuckets, useKM03=False):
     subRate, _rootProb, _indelParams, _alnTypeWeight, colTypeWeight, colQuantiles = model
     nAlignTypes, nColTypes = colTypeWeight.shape
     nQuantiles = len(colQuantiles)
     alphabetSize = subRate.shape[-1]
-    a_count = np.zeros (nAlignTypes)
-    at_count = np.zeros ((nAlignTypes, nColTypes))
-    rootCount = np.zeros ((nQuantiles, nColTypes, alphabetSize))
-    count_by_t = {}  # count_by_t[discretizedTime] = (subRateCount, transCounts)
-    ll = 0.
-    for data in tqdm(dataset):
-        a_pp, at_c, qtc_pp, a_ll = getPosteriorWeights (data, model, **kwargs)
-        a_count += a_pp
-        at_count += at_c
-        ll += a_ll
-        rootCount, count_by_t = countWeightedCherries (data, alphabetSize, a_pp=a_pp, qtc_pp=qtc_pp, rootCount=rootCount, count_by_t=count_by_t, logBase=logBase)
-    ts, subRateCount, transCount = cherryCountsToArrays (count_by_t)
-    return a_count, at_count, ts, rootCount, subRateCount, transCount, ll
+    def step (counts, item):
+        data, (I, J, pairTransCount, bucket) = item
+        a_pp, at_count, qtc_pp, ll = getPosteriorWeights (data, model, useKM03=useKM03)
+        rootCount, subRateCount, transCount = accumulateCherryCounts (data[0], qtc_pp, a_pp, I, J, pairTransCount, bucket, nBuckets=nBuckets, alphabetSize=alphabetSize)
+        return jax.tree_util.tree_map (jnp.add, counts, (a_pp, at_count, rootCount, subRateCount, transCount, ll)), None
+    init = (jnp.zeros (nAlignTypes),
+            jnp.zeros ((nAlignTypes, nColTypes)),
+            jnp.zeros ((nQuantiles, nColTypes, alphabetSize)),
+            jnp.zeros ((nBuckets, nQuantiles, nColTypes, alphabetSize, alphabetSize)),
+            jnp.zeros ((nBuckets, nAlignTypes, 3, 3)),
+            jnp.zeros (()))
+    counts, _ = jax.lax.scan (step, init, group)
+    return counts
+
+# Everything the E-step needs from the dataset that does not depend on the parameters: cherries, their time buckets,
+# and the alignments stacked into same-shaped groups (on-device), so that repeated E-steps reuse them and the compiled scans
+# Returns (ts, groups) where ts is (nBuckets,)
+def prepareDatasetGroups (dataset, logBase=defaultLogBase, n_jobs=1):
+    cherries = prepareDatasetCherries (dataset, logBase=logBase, n_jobs=n_jobs)
+    dts, buckets = bucketCherryTimes (cherries)
+    groups = stackDatasetByShape (dataset, cherries, buckets, len(dts))
+    return undiscretizeTime (dts, logBase=logBase), groups
+
+def getPosteriorCounts (dataset, params, model_factory, scanPosteriorCounts=scanPosteriorCounts, logBase=defaultLogBase, preparedDataset=None, **kwargs):
+    model = model_factory (params)
+    if preparedDataset is None:
+        preparedDataset = prepareDatasetGroups (dataset, logBase=logBase)
+    ts, groups = preparedDataset
+    # dispatch every group before reading any results back, so JAX's asynchronous dispatch can overlap them
+    groupCounts = [scanPosteriorCounts (group, model, nBuckets=len(ts), **kwargs) for group in groups]
+    a_count, at_count, rootCount, subRateCount, transCount, ll = (np.asarray (sum (counts)) for counts in zip (*groupCounts))
+    return a_count, at_count, ts, rootCount, subRateCount, transCount, ll.item()
 
 def selectAlignAndColType (params, nType):
     params = deepcopy(params)
@@ -177,24 +261,24 @@ def selectAlignAndColType (params, nType):
     return params
 
 def createCompositeSubLoss (model_factory):
-    def compositeSubLoss (params, ts, rootCount, subRateCount):
+    # use_bf16 evaluates the substitution term in bfloat16 (root term stays float32); pass it as a static arg under jit
+    def compositeSubLoss (params, ts, rootCount, subRateCount, use_bf16=False):
         subRate, rootProb, _indelParams, _alnTypeWeight, _colTypeWeight, _colQuantiles = model_factory (params)
-        subMatrix = likelihood.computeSubMatrixForTimes (ts, subRate)  # (nQuantiles, nColTypes, nDiscretizedTimes, alphabetSize, alphabetSize)
-        subMatrix = einops.rearrange (subMatrix, 'q c t i j -> t q c i j')
-        return -jnp.sum(subRateCount * jnp.log(subMatrix)) - jnp.sum(rootCount * jnp.log(rootProb))
+        subMatrix = expm (jnp.einsum ('qcij,t->tqcij', subRate, ts))  # (nDiscretizedTimes, nQuantiles, nColTypes, alphabetSize, alphabetSize), same layout as subRateCount
+        if use_bf16:
+            subLoss = -jnp.sum(subRateCount.astype(jnp.bfloat16) * jnp.log(subMatrix.astype(jnp.bfloat16))).astype(jnp.float32)
+        else:
+            subLoss = -jnp.sum(subRateCount * jnp.log(subMatrix))
+        return subLoss - jnp.sum(rootCount * jnp.log(rootProb))
     return compositeSubLoss
 
 def createCompositeIndelLoss (model_factory, useKM03=False, **kwargs):
-    transitionMatrix = km03.transitionMatrix if useKM03 else h20.transitionMatrix
     def compositeIndelLoss (params, ts, transCount):
-        subRate, _rootProb, indelParams, alnTypeWeight, _colTypeWeight, _colQuantiles = model_factory (params)
-        nAlignTypes = alnTypeWeight.shape[0]
+        subRate, _rootProb, indelParams, _alnTypeWeight, _colTypeWeight, _colQuantiles = model_factory (params)
         alphabetSize = subRate.shape[-1]
-        loss = 0.
-        for a in range(nAlignTypes):
-            logTransMat = jnp.log (jnp.stack ([transitionMatrix(t,indelParams[a],alphabetSize=alphabetSize) for t in ts], axis=0))
-            loss -= jnp.sum (transCount[:,a,:,:] * logTransMat)
-        return loss
+        transMatForTimes = jax.vmap (lambda t, p: likelihood.transitionMatrix (t, p, alphabetSize=alphabetSize, useKM03=useKM03), in_axes=(0,None))
+        logTransMat = jnp.log (jax.vmap (transMatForTimes, in_axes=(None,0)) (ts, indelParams))  # (nAlignTypes, nDiscretizedTimes, 3, 3)
+        return -jnp.einsum ('taij,atij->', transCount, logTransMat)
     return compositeIndelLoss
 
 def createCompositeAlignmentLogLike (sub_loss, indel_loss):
@@ -202,21 +286,27 @@ def createCompositeAlignmentLogLike (sub_loss, indel_loss):
         return -(sub_loss (params, ts, rootCount, subRateCount) + indel_loss (params, ts, transCount))
     return compositeAlignmentLogLike
 
-def optimizeByPhyloExpectationCompositeMaximization (dataset, model_factory, params, use_jit=True, useKM03=False, init_lr=None, show_grads=None, verbosity=1, **kwargs):
+# bf16_after: if set, evaluate the substitution loss in bfloat16 from this (0-based) EM step onwards, once counts have stabilized
+def optimizeByPhyloExpectationCompositeMaximization (dataset, model_factory, params, use_jit=True, useKM03=False, init_lr=None, show_grads=None, verbosity=1, n_jobs=1, bf16_after=None, **kwargs):
     if use_jit:
         value_and_grad = lambda f: jax.jit (jax.value_and_grad (f))
-        getPosteriorWeights_jit = jax.jit (getPosteriorWeights, static_argnames=('alphabetSize', 'useKM03'))
+        sub_loss_value_and_grad = jax.jit (jax.value_and_grad (createCompositeSubLoss (model_factory)), static_argnames=('use_bf16',))
+        scanPosteriorCounts_jit = jax.jit (scanPosteriorCounts, static_argnames=('nBuckets',))  # useKM03 is traced, so toggling it does not recompile
     else:
         value_and_grad = jax.value_and_grad
-        getPosteriorWeights_jit = getPosteriorWeights
-    sub_loss_value_and_grad = value_and_grad (createCompositeSubLoss (model_factory))
+        sub_loss_value_and_grad = jax.value_and_grad (createCompositeSubLoss (model_factory))
+        scanPosteriorCounts_jit = scanPosteriorCounts
     trans_loss_value_and_grad = value_and_grad (createCompositeIndelLoss (model_factory, useKM03=useKM03))
     optax_args = dict((k,v) for k,v in [('init_lr',init_lr),('show_grads',show_grads)] if v is not None)
+    logging.warning("Preprocessing alignment dataset")
+    preparedDataset = prepareDatasetGroups (dataset, n_jobs=n_jobs)
     def take_step (params, nStep):
         logging.warning("E-step %d: computing posterior counts" % (nStep+1))
-        a_count, at_count, ts, rootCount, subRateCount, transCount, ll = getPosteriorCounts(dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights_jit, useKM03=useKM03)
+        a_count, at_count, ts, rootCount, subRateCount, transCount, ll = getPosteriorCounts(dataset, params, model_factory, scanPosteriorCounts=scanPosteriorCounts_jit,
+                                                                                           preparedDataset=preparedDataset, useKM03=useKM03)
         logging.warning ("M-step %d: optimizing composite likelihoods (actual loss %f)" % (nStep+1, -ll))
-        sub_loss_vg_bound = lambda params: sub_loss_value_and_grad (params, ts, rootCount, subRateCount)
+        use_bf16 = bf16_after is not None and nStep >= bf16_after
+        sub_loss_vg_bound = lambda params: sub_loss_value_and_grad (params, ts, rootCount, subRateCount, use_bf16=use_bf16)
         trans_loss_vg_bound = lambda params: trans_loss_value_and_grad (params, ts, transCount)
         params, _sub_ll = optimize (sub_loss_vg_bound, params, prefix=f"EM step {nStep+1}, substitution params iteration ", verbose=verbosity>1, **optax_args, **kwargs)
         #*stuff, new_a_ll = getPosteriorWeights_jit (dataset[0], model_factory(params))
@@ -227,11 +317,11 @@ def optimizeByPhyloExpectationCompositeMaximization (dataset, model_factory, par
         return params, -ll
     return optimize_generic (take_step, params, prefix="EM step ", verbose=verbosity>0, **kwargs)
 
-def optimizeByCompositeExpectationMaximization (dataset, model_factory, params, use_jit=True, useKM03=False, init_lr=None, show_grads=None, verbosity=1, **kwargs):
+def optimizeByCompositeExpectationMaximization (dataset, model_factory, params, use_jit=True, useKM03=False, init_lr=None, show_grads=None, verbosity=1, n_jobs=1, bf16_after=None, **kwargs):
     jit = jax.jit if use_jit else lambda f: f
     sub_loss = createCompositeSubLoss (model_factory)
     trans_loss = createCompositeIndelLoss (model_factory, useKM03=useKM03)
-    sub_loss_value_and_grad = jit (jax.value_and_grad (sub_loss))
+    sub_loss_value_and_grad = jax.jit (jax.value_and_grad (sub_loss), static_argnames=('use_bf16',)) if use_jit else jax.value_and_grad (sub_loss)
     trans_loss_value_and_grad = jit (jax.value_and_grad (trans_loss))
     align_loglike = jit (createCompositeAlignmentLogLike (sub_loss, trans_loss))
     optax_args = dict((k,v) for k,v in [('init_lr',init_lr),('show_grads',show_grads)] if v is not None)
@@ -241,29 +331,25 @@ def optimizeByCompositeExpectationMaximization (dataset, model_factory, params,
     assert nQuantiles==1, 'Composite EM currently only supports one quantile (FIXME)'  # could fix by prescaling columns by estimated rate, as in CherryML paper
     assert params['coltypelogits'] == jnp.log(jnp.eye(nAlignTypes)), 'Composite EM requires a one-to-one mapping between alignments & columns'
     nColTypes = nAlignTypes
-    datasetCounts = list(getDatasetCounts (dataset, alphabetSize))
+    ts, datasetCounts = getDatasetCounts (dataset, alphabetSize, n_jobs=n_jobs)
     def take_step (params, nStep):
-        rootCount = np.zeros ((nQuantiles, nColTypes, alphabetSize))
-        count_by_t = {}  # count_by_t[discretizedTime] = (subRateCount, transCounts)
+        rootCount = np.zeros ((nQuantiles, nColTypes, alphabetSize), dtype=np.float32)
+        subRateCount = np.zeros ((len(ts), nQuantiles, nColTypes, alphabetSize, alphabetSize), dtype=np.float32)
+        transCount = np.zeros ((len(ts), nAlignTypes, 3, 3), dtype=np.float32)
         logging.warning("E-step %d: computing posterior alignment weights" % (nStep+1))
         ll = 0.
-        a_count = np.zeros (nAlignTypes)
+        a_count = np.zeros (nAlignTypes, dtype=np.float32)
         a_logprior = params['alntypelogits'] - logsumexp(params['alntypelogits'])
-        for rc, cbt, ts, subRateCount, transCount in tqdm(datasetCounts):
-            a_ll = jnp.array ([align_loglike (selectAlignAndColType(params,n), ts, rc, subRateCount, transCount) for n in range(nAlignTypes)])
-            a_pp = jax.nn.softmax(a_ll)
+        for rc, bucketIdx, data_ts, data_subRateCount, data_transCount in tqdm(datasetCounts):
+            a_ll = jnp.array ([align_loglike (selectAlignAndColType(params,n), data_ts, rc, data_subRateCount, data_transCount) for n in range(nAlignTypes)])
+            a_pp = np.asarray (jax.nn.softmax(a_ll))
             a_count += a_pp
             ll += logsumexp (a_ll + a_logprior)
-            for dt in cbt:
-                subRateCount_dt_for_aln, transCount_dt_for_aln = cbt[dt]
-                subRateCount_dt, transCount_dt = count_by_t.get (dt, (np.zeros((nQuantiles, nColTypes, alphabetSize, alphabetSize)),
-                                                                      np.zeros((nAlignTypes, 3, 3))))
-                subRateCount_dt += subRateCount_dt_for_aln * a_pp[None,:,None,None]
-                transCount_dt += transCount_dt_for_aln * a_pp[:,None,None]
-                count_by_t[dt] = subRateCount_dt, transCount_dt
-        ts, subRateCount, transCount = cherryCountsToArrays (count_by_t)
+            subRateCount[bucketIdx] += data_subRateCount * a_pp[None,None,:,None,None]
+            transCount[bucketIdx] += data_transCount * a_pp[None,:,None,None]
         logging.warning ("M-step %d: optimizing composite likelihoods (total loss %f)" % (nStep+1, -ll))
-        sub_loss_vg_bound = lambda params: sub_loss_value_and_grad (params, ts, rootCount, subRateCount)
+        use_bf16 = bf16_after is not None and nStep >= bf16_after
+        sub_loss_vg_bound = lambda params: sub_loss_value_and_grad (params, ts, rootCount, subRateCount, use_bf16=use_bf16)
         trans_loss_vg_bound = lambda params: trans_loss_value_and_grad (params, ts, transCount)
         params, _sub_ll = optimize (sub_loss_vg_bound, params, prefix=f"EM step {nStep+1}, substitution params iteration ", verbose=verbosity>1, **optax_args, **kwargs)
         params, _trans_ll = optimize (trans_loss_vg_bound, params, prefix=f"EM step {nStep+1}, indel params iteration ", verbose=verbosity>1, **optax_args, **kwargs)
@@ -0,0 +1,151 @@
+import os
+import json
+import unittest
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+import cigartree
+import likelihood
+import cherry
+
+jax.config.update('jax_platform_name', 'cpu')
+
+dataDir = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'data')
+
+# Same as dataset.loadTreeAndAlignment, but from strings
+def makeAlignment (treeStr, alignStr, alphabet):
+    seqs, _nodeName, distanceToParent, parentIndex, transCounts = cigartree.getHMMSummaries (treeStr, alignStr, alphabet)
+    return likelihood.padAlignment (seqs, parentIndex, distanceToParent, transCounts)
+
+# Two-type mixture model derived from the LG08 substitution model
+def makeModel (nTypes = 2, nQuantiles = 2):
+    with open (os.path.join (dataDir, 'lg08.json'), 'r') as f:
+        modelJson = json.load (f)
+    alphabet, mixture, indelParams, *_rest = likelihood.parseHistorianParams (modelJson)
+    indelParams = likelihood.indelModelToLogits (*indelParams[0])
+    subRate, rootProb = mixture[0]
+    params = { 'indels': [indelParams * (1 + 0.3*k) for k in range(nTypes)],
+               'subs': [{'subrate': likelihood.zeroDiagonal(subRate) * (1 + 0.5*k), 'rootlogits': likelihood.probsToLogits(rootProb)} for k in range(nTypes)],
+               'alntypelogits': jnp.zeros(nTypes),
+               'coltypelogits': jnp.log (jnp.eye(nTypes) * 0.8 + 0.1),
+               'colshape': jnp.ones(nTypes) * 0.7 }
+    return alphabet, params, likelihood.createGGIModelFactory (likelihood.parametricSubModel, nQuantiles)
+
+# Random tree with integer branch lengths, in preorder, followed by nPadding padding rows (as added by likelihood.padAlignment)
+def randomTree (rng, nNodes, nPadding = 0):
+    parent = [-1] + [int (rng.integers(n)) for n in range(1,nNodes)]
+    children = [[] for _ in range(nNodes)]
+    for n in range(1,nNodes):
+        children[parent[n]].append (n)
+    order, stack = [], [0]
+    while len(stack) > 0:
+        n = stack.pop()
+        order.append (n)
+        stack.extend (reversed (children[n]))
+    newIndex = { n: k for k, n in enumerate(order) }
+    parentIndex = [-1] + [newIndex[parent[n]] for n in order[1:]] + list (range (nNodes, nNodes + nPadding))
+    distanceToParent = [0] + [int (rng.integers(1,4)) for _ in range(1,nNodes)] + [0] * nPadding
+    return parentIndex, distanceToParent
+
+# Greedy pairing over all leaf pairs: repeatedly take the closest available pair, breaking ties by leaf indices
+def bruteForceCherries (parentIndex, distanceToParent):
+    nodes = [n for n, p in enumerate(parentIndex) if p != n]
+    leaves = [n for n in nodes if n not in parentIndex[1:]]
+    depth, ancestors = {}, {}
+    for n in nodes:
+        p = parentIndex[n]
+        depth[n] = depth[p] + distanceToParent[n] if p >= 0 else 0
+        ancestors[n] = (ancestors[p] if p >= 0 else []) + [n]
+    def distance (i, j):
+        lca = max (set(ancestors[i]) & set(ancestors[j]))  # in preorder, the deepest common ancestor has the highest index
+        return depth[i] + depth[j] - 2 * depth[lca]
+    cherries = []
+    available = set (leaves)
+    while len(available) > 1:
+        dij, i, j = min ((distance(i,j), i, j) for i in available for j in available if i < j)
+        cherries.append (((i,j), dij))
+        available -= {i, j}
+    return cherries
+
+class TestCherry (unittest.TestCase):
+
+    # The heap-based cherry picker should choose the same pairs, in the same order, as an exhaustive greedy search
+    def test_pick_cherries (self):
+        rng = np.random.default_rng (42)
+        for _trial in range(200):
+            parentIndex, distanceToParent = randomTree (rng, int (rng.integers(2,30)), nPadding = int (rng.integers(0,3)))
+            self.assertEqual (cherry.pickCherries (parentIndex, distanceToParent), bruteForceCherries (parentIndex, distanceToParent))
+
+    # Batched pairwise indel transition counts should match the per-pair expanded-cigar counts
+    def test_count_transitions (self):
+        rng = np.random.default_rng (42)
+        for _trial in range(100):
+            nPairs, nCols = int (rng.integers(1,5)), int (rng.integers(1,20))
+            gapProb = rng.random()
+            tokens = lambda: np.where (rng.random((nPairs,nCols)) < gapProb, -1, rng.integers(0,4,(nPairs,nCols)))
+            parentRows, childRows = tokens(), tokens()
+            transCounts = cigartree.countTransitionsInTokenizedPairwiseAlignments (parentRows, childRows)
+            for p in range(nPairs):
+                _gapSizeCounts, expected = cigartree.countGapSizesInTokenizedPairwiseAlignment (list(parentRows[p]), list(childRows[p]))
+                self.assertTrue (np.array_equal (transCounts[p], expected))
+
+    # The vectorized E-step accumulation should match a loop over cherries
+    def test_accumulate_cherry_counts (self):
+        rng = np.random.default_rng (42)
+        nRows, nCols, nCherries, nQuantiles, nColTypes, nAlignTypes, nBuckets, alphabetSize = 8, 6, 3, 2, 2, 2, 2, 4
+        seqs = np.where (rng.random((nRows,nCols)) < 0.2, -1, rng.integers(0,alphabetSize,(nRows,nCols)))
+        qtc_pp = rng.random((nQuantiles,nColTypes,nCols))
+        a_pp = rng.random(nAlignTypes)
+        I, J = np.array([1,3,5]), np.array([2,4,6])
+        pairTransCount = rng.random((nCherries,3,3))
+        bucket = np.array([1,0,1])
+        rootCount, subRateCount, transCount = cherry.accumulateCherryCounts (jnp.array(seqs), jnp.array(qtc_pp), jnp.array(a_pp), jnp.array(I), jnp.array(J),
+                                                                           jnp.array(pairTransCount), jnp.array(bucket), nBuckets=nBuckets, alphabetSize=alphabetSize)
+        expectedRoot = np.zeros((nQuantiles,nColTypes,alphabetSize))
+        expectedSub = np.zeros((nBuckets,nQuantiles,nColTypes,alphabetSize,alphabetSize))
+        expectedTrans = np.zeros((nBuckets,nAlignTypes,3,3))
+        for p in range(nCherries):
+            for c in range(nCols):
+                x, y = seqs[I[p],c], seqs[J[p],c]
+                for s in (x, y):
+                    if s >= 0:
+                        expectedRoot[:,:,s] += qtc_pp[:,:,c] / 2
+                if x >= 0 and y >= 0:
+                    expectedSub[bucket[p],:,:,x,y] += qtc_pp[:,:,c] / 2
+                    expectedSub[bucket[p],:,:,y,x] += qtc_pp[:,:,c] / 2
+            expectedTrans[bucket[p]] += a_pp[:,None,None] * pairTransCount[p]
+        self.assertTrue (np.allclose (rootCount, expectedRoot, rtol=1e-5))
+        self.assertTrue (np.allclose (subRateCount, expectedSub, rtol=1e-5))
+        self.assertTrue (np.allclose (transCount, expectedTrans, rtol=1e-5))
+
+    # Alignments of the same padded shape are stacked into one group, with their cherries padded to a common number.
+    # The group's counts should equal the sum of each alignment's counts when accumulated alone (i.e. without padding).
+    # The root row is ungapped, so padding cherries (which point at row 0) would otherwise contribute to rootCount
+    def test_grouped_posterior_counts (self):
+        alphabet, params, model_factory = makeModel()
+        data = [makeAlignment ("((A:.1,B:.2)X:.3,(C:.3,D:.4)Y:.5)R;",
+                               ">R\nMLSSKVAR\n>X\nMLSSKVAR\n>A\nMLSS-VAR\n>B\nMLTSKV-R\n>Y\nMLSAKVAR\n>C\nMISAK-AR\n>D\nMLSAKVGR\n", alphabet),
+                makeAlignment ("((A:.1,B:.2)X:.3,C:.4)R;",
+                               ">R\nMKSSLVAR\n>X\nMKSSLVAR\n>A\nMKS-LVAR\n>B\nMRSSLVAR\n>C\nMKSSLV-K\n", alphabet)]
+        self.assertEqual (data[0][0].shape, data[1][0].shape)
+        a_count, at_count, ts, rootCount, subRateCount, transCount, ll = cherry.getPosteriorCounts (data, params, model_factory)
+        expected = [np.zeros_like(x) for x in (a_count, at_count, rootCount, subRateCount, transCount)]
+        expected_ll = 0
+        for d in data:
+            d_a_count, d_at_count, d_ts, d_rootCount, d_subRateCount, d_transCount, d_ll = cherry.getPosteriorCounts ([d], params, model_factory)
+            bucket = np.searchsorted (np.asarray(ts), np.asarray(d_ts))  # this alignment's time buckets within the whole dataset's
+            self.assertTrue (np.allclose (np.asarray(ts)[bucket], d_ts))
+            expected[0] += d_a_count
+            expected[1] += d_at_count
+            expected[2] += d_rootCount
+            expected[3][bucket] += d_subRateCount
+            expected[4][bucket] += d_transCount
+            expected_ll += d_ll
+        for actual, exp in zip ((a_count, at_count, rootCount, subRateCount, transCount), expected):
+            self.assertTrue (np.allclose (actual, exp, rtol=1e-4, atol=1e-4))
+        self.assertTrue (np.isclose (ll, expected_ll, rtol=1e-5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -132,6 +132,26 @@ def countGapSizesInTokenizedPairwiseAlignment (parentRow, childRow):
     gapSizeCounts, transCounts = countGapSizes ([expandedCigar])
     return gapSizeCounts[0], transCounts[0]
 
+# Batched, vectorized equivalent of the transCounts returned by countGapSizesInTokenizedPairwiseAlignment
+# parentRows, childRows: (P,C) integer tokens, with -1 indicating a gap
+# Returns (P,3,3) transition counts between the states 'MID', including the implicit M states at the start and end
+def countTransitionsInTokenizedPairwiseAlignments (parentRows, childRows):
+    parentRows = np.asarray (parentRows)
+    childRows = np.asarray (childRows)
+    P, C = parentRows.shape
+    assert childRows.shape == (P, C), "Rows must be the same length"
+    state = np.where (parentRows < 0, 1, np.where (childRows < 0, 2, 0))  # index into 'MID'
+    present = (parentRows >= 0) | (childRows >= 0)  # columns that appear in the expanded cigar
+    # pad with the implicit start and end M states
+    state = np.pad (state, ((0,0),(1,1)))
+    present = np.pad (present, ((0,0),(1,1)), constant_values=True)
+    lastPresent = np.maximum.accumulate (np.where (present, np.arange(C+2)[None,:], 0), axis=1)  # (P,C+2)
+    prevState = np.take_along_axis (state, lastPresent[:,:-1], axis=1)  # (P,C+1). State preceding each column
+    row, col = np.nonzero (present[:,1:])
+    transCounts = np.zeros ((P,3,3))
+    np.add.at (transCounts, (row, prevState[row,col], state[row,col+1]), 1)
+    return transCounts
+
 def compressCigarString (stateStr):
     s = None
     n = 0
@@ -2,23 +2,24 @@ import numpy as np
 import jax
 import jax.numpy as jnp
 from jax.scipy.linalg import expm
+from jax.scipy.special import logsumexp
 import diffrax
+import opt_einsum
 
 from bounded_while_loop import bounded_optimize
 
-smallest_float32 = jnp.finfo('float32').smallest_normal
-
 def product(x,axis=None,keepdims=False):
     return jnp.exp(jnp.sum(safe_log(x),axis=axis,keepdims=keepdims))
 
-def offdiag_mask (N):
-    return jnp.ones((N,N)) - jnp.eye(N)
+def offdiag_mask (N, dtype=jnp.float32):
+    return jnp.ones((N,N), dtype=dtype) - jnp.eye(N, dtype=dtype)
 
+# the floors follow x's dtype, so that reduced-precision inputs are not promoted back to float32
 def safe_log (x):
-    return jnp.log (jnp.maximum (x, smallest_float32))
+    return jnp.log (jnp.maximum (x, jnp.finfo(x.dtype).smallest_normal))
 
 def safe_recip (x):
-    return 1 / jnp.maximum (x, smallest_float32)
+    return 1 / jnp.maximum (x, jnp.finfo(x.dtype).smallest_normal)
 
 def symmetrise (matrix):
     return (matrix + matrix.swapaxes(-1,-2)) / 2
@@ -33,13 +34,13 @@ def round_up_to_power (x, base=2):
         x = int (jnp.ceil (base ** jnp.ceil (jnp.log(x) / jnp.log(base))))
     return x
 
-def logsumexp (x, axis=None, keepdims=False):
-    max_x = jnp.max (x, axis=axis, keepdims=keepdims)
-    return jnp.log(jnp.sum(jnp.exp(x - max_x), axis=axis, keepdims=keepdims)) + max_x
+# Stacked pytrees: structurally identical pytrees (e.g. diffrax Solution's) held as one pytree with a leading axis
+def unstack_pytrees (stacked, n):
+    return [jax.tree_util.tree_map (lambda leaf: leaf[k], stacked) for k in range(n)]
+
+def replace_nth (stacked, n, new_nth_elt):
+    return jax.tree_util.tree_map (lambda leaf, new_leaf: leaf.at[n].set(new_leaf), stacked, new_nth_elt)
 
-def replace_nth (old_arr, n, new_nth_elt):
-    return [jax.lax.cond (k==n, lambda x:new_nth_elt, lambda x:x, old_kth_elt) for k, old_kth_elt in enumerate(old_arr)]
-    
 # Implements the algorithm from Cohn et al (2010), for protein Potts models parameterized by contact & coupling matrices
 # Cohn et al (2010), JMLR 11:93. Mean Field Variational Approximation for Continuous-Time Bayesian Networks
 
@@ -58,9 +59,23 @@ def replace_nth (old_arr, n, new_nth_elt):
 #  nbr_mask = sparse neighbor flag matrix (M*L). nbr_mask[i,n] is 1 if nbr_idx[i,n] is a real neighbor, 0 otherwise
 
 def normalise_ctbn_params (params):
-    return { 'S' : symmetrise(row_normalise(jnp.abs(params['S']))),
-             'J' : symmetrise(params['J']),
-             'h' : params['h'] }
+    return precompute_ctbn_tables ({ 'S' : symmetrise(row_normalise(jnp.abs(params['S']))),
+                                     'J' : symmetrise(params['J']),
+                                     'h' : params['h'] })
+
+# Add tables derived from (S,J,h) that the rate functions need, so they are computed once per parameter set
+# rather than at every ODE step. Does nothing if the tables are already present
+def precompute_ctbn_tables (params):
+    if 'exp_2J' in params:
+        return params
+    N = params['S'].shape[0]
+    exp_h = jnp.exp (params['h'])
+    offdiag = offdiag_mask(N, dtype=exp_h.dtype)  # floating point, even if S is given as integers
+    return { **params,
+             'offdiag' : offdiag,  # (N,N)
+             'S_off' : params['S'] * offdiag,  # (x_i,y_i)
+             'exp_2J' : jnp.exp (2 * params['J']),  # (y_i,x_k)
+             'exp_h' : exp_h }  # (y_i,)
 
 # Rate for substitution x_i->y_i conditioned on neighboring x's
 #  i = 1..K
@@ -79,69 +94,73 @@ def q_k (i, x, y_i, nbr_idx, nbr_mask, params):
 # Mean-field averaged rates for a continuous-time Bayesian network
 # Returns (A,N,N) matrix where entry (a,x_{idx[a]},y_{idx[a]}) is mean-field averaged rate matrix for component idx[a]
 def q_bar (idx, nbr_idx, nbr_mask, params, mu):
-    N = mu.shape[-1]
-    S = params['S']
-    J = params['J']
-    h = params['h']
-    exp_2J = jnp.exp (2 * J)  # (y_i,x_k)
-    exp_2JC = exp_2J[None,None,:,:]  # (a,k,y_i,x_{nbr_k})
-    mu_nbr = mu[nbr_idx[idx]]  # (a,k,x_{nbr_k})
-    mu_exp_2JC = jnp.einsum ('akx,akyx->aky', mu_nbr, exp_2JC) ** nbr_mask[idx][:,:,None]  # (a,k,y_i)
-#    jax.debug.print("exp_2JC={exp_2JC} mu_nbr={mu_nbr} mu_exp_2JC={mu_exp_2JC} nbr_mask[idx]={nm}",mu_exp_2JC=mu_exp_2JC,exp_2JC=exp_2JC,mu_nbr=mu_nbr,nm=nbr_mask[idx])
-    S = S * offdiag_mask(N)
-    return S[None,:,:] * jnp.exp(h)[None,None,:] * product(mu_exp_2JC,axis=-2,keepdims=True)  # (a,x_i,y_i)
+    return q_bar_and_tilde (idx, nbr_idx, nbr_mask, params, mu)[0]
 
 # Returns (M,N,N,N) tensor where entry (j,x_j,x_i,y_i) is the mean-field averaged rate x_i->y_i, conditioned on component nbr_idx[i,j] being in state x_{nbr_idx[i,j]}
 # NB only valid for x_i != y_i
 def q_bar_cond (i, nbr_idx, nbr_mask, params, mu):
+    params = precompute_ctbn_tables (params)
+    cond_factor, rate_factor = q_bar_cond_factors (i, nbr_idx, nbr_mask, params, mu)
+    return params['S_off'][None,None,:,:] * cond_factor[:,:,None,:] * rate_factor[:,None,None,:]  # (j,x_{nbr_j},x_i,y_i)
+
+# Factorization of q_bar_cond that avoids building the (M,N,N,N) tensor:
+#  q_bar_cond[j,x_{nbr_j},x_i,y_i] = S_off[x_i,y_i] * cond_factor[j,x_{nbr_j},y_i] * rate_factor[j,y_i]
+# Returns (M,N,N) cond_factor and (M,N) rate_factor
+def q_bar_cond_factors (i, nbr_idx, nbr_mask, params, mu):
     M = nbr_idx.shape[-1]
-    N = mu.shape[-1]
-    S = params['S']
-    J = params['J']
-    h = params['h']
-    nonself_nbr_mask = offdiag_mask(M) * jnp.outer(nbr_mask[i],nbr_mask[i])  # (j,k)
-    cond_energy = nbr_mask[i,:,None,None] * J[None,:,:]  # (j,x_{nbr_j},y_i)
-    exp_2J = jnp.exp (2 * J)  # (N,N)
-    exp_2JC = exp_2J[None,None,:,:] ** nonself_nbr_mask[:,:,None,None]  # (j,k,y_i,x_{nbr_k})
-    mu_nbr = mu[nbr_idx[i]] ** nbr_mask[i,:]  # (k,x_{nbr_k})
-    mu_exp_JC = jnp.einsum ('kx,jkyx->jky', mu_nbr, exp_2JC)  # (j,k,y_i)
-    S = S * offdiag_mask(N)
-    return S[None,None,:,:] * jnp.exp(h)[None,None,None,:] * jnp.exp(-2*cond_energy)[:,:,None,:] * product(mu_exp_JC,axis=-2)[:,None,None,:]  # (j,x_{nbr_j},x_i,y_i)
+    params = precompute_ctbn_tables (params)
+    nonself_nbr_mask = offdiag_mask(M, dtype=mu.dtype) * jnp.outer(nbr_mask[i],nbr_mask[i])  # (j,k)
+    cond_energy = nbr_mask[i,:,None,None] * params['J'][None,:,:]  # (j,x_{nbr_j},y_i)
+    mu_exp_2J = jnp.einsum ('kx,yx->ky', mu[nbr_idx[i]], params['exp_2J'])  # (k,y_i)
+    # excluded neighbors (k=j, or padding) contribute a factor of 1 to the product over k
+    mu_exp_JC = jnp.where (nonself_nbr_mask[:,:,None] > 0, mu_exp_2J[None,:,:], 1)  # (j,k,y_i)
+    return jnp.exp(-2*cond_energy), params['exp_h'][None,:] * product(mu_exp_JC,axis=-2)  # (j,x_{nbr_j},y_i), (j,y_i)
 
 # Geometrically-averaged mean-field rates for a continuous-time Bayesian network
 # Returns (A,N,N) matrix where entry (a,x_{idx[a]},y_{idx[a]}) is geometrically-averaged mean-field rate matrix for component idx[a]
 # NB only valid for x_i != y_i
 def q_tilde (idx, nbr_idx, nbr_mask, params, mu):
-    N = mu.shape[-1]
-    S = params['S']
-    J = params['J']
-    h = params['h']
-    mean_energy = jnp.einsum ('akx,ak,yx->ay', mu[nbr_idx[idx,:]], nbr_mask[idx,:], J)  # (a,y_i)
-    S = S * offdiag_mask(N)
-    return S[None,:,:] * jnp.exp(h+2*mean_energy)[:,None,:]  # (a,x_i,y_i)
+    return q_bar_and_tilde (idx, nbr_idx, nbr_mask, params, mu)[1]
+
+# Computes q_bar and q_tilde together, gathering the neighbors' mean-field probabilities only once
+# Returns a pair of (A,N,N) matrices
+# For a single component, idx can also be a scalar, in which case the leading (A,) axis is dropped and the matrices are (N,N)
+def q_bar_and_tilde (idx, nbr_idx, nbr_mask, params, mu):
+    params = precompute_ctbn_tables (params)
+    mu_nbr = mu[nbr_idx[idx]]  # (a,k,x_{nbr_k})
+    mask = nbr_mask[idx]  # (a,k)
+    log_mu_exp_2JC = safe_log (jnp.einsum ('...kx,yx->...ky', mu_nbr, params['exp_2J']))  # (a,k,y_i)
+#    jax.debug.print("mu_nbr={mu_nbr} log_mu_exp_2JC={lm} nbr_mask[idx]={nm}",lm=log_mu_exp_2JC,mu_nbr=mu_nbr,nm=mask)
+    mean_energy = jnp.einsum ('...kx,...k,yx->...y', mu_nbr, mask, params['J'])  # (a,y_i)
+    # product over real neighbors k, taken as a masked sum of logs
+    qbar = params['S_off'] * params['exp_h'] * jnp.exp(jnp.einsum('...ky,...k->...y', log_mu_exp_2JC, mask))[...,None,:]  # (a,x_i,y_i)
+    qtilde = params['S_off'] * jnp.exp(params['h']+2*mean_energy)[...,None,:]  # (a,x_i,y_i)
+    return qbar, qtilde
 
 # Returns (M,N,N,N) matrix where entry (j,x_j,x_i,y_i) is the geometrically-averaged rate x_i->y_i, conditioned on component nbr_idx[i,j] being in state x_{nbr_idx[i,j]}
 # NB only valid for x_i != y_i
 def q_tilde_cond (i, nbr_idx, nbr_mask, params, mu):
+    params = precompute_ctbn_tables (params)
+    log_cond_factor, log_rate_factor = q_tilde_cond_log_factors (i, nbr_idx, nbr_mask, params, mu)
+    return params['S_off'][None,None,:,:] * jnp.exp(log_cond_factor)[:,:,None,:] * jnp.exp(log_rate_factor)[:,None,None,:]  # (j,x_{nbr_j},x_i,y_i)
+
+# Factorization of log(q_tilde_cond), as for q_bar_cond_factors:
+#  log q_tilde_cond[j,x_{nbr_j},x_i,y_i] = log S_off[x_i,y_i] + log_cond_factor[j,x_{nbr_j},y_i] + log_rate_factor[j,y_i]
+# Returns (M,N,N) log_cond_factor and (M,N) log_rate_factor
+def q_tilde_cond_log_factors (i, nbr_idx, nbr_mask, params, mu):
     M = nbr_idx.shape[-1]
-    N = mu.shape[-1]
-    S = params['S']
     J = params['J']
-    h = params['h']
-    nonself_nbr_mask = offdiag_mask(M) * jnp.outer(nbr_mask[i],nbr_mask[i])  # (j,k)
+    nonself_nbr_mask = offdiag_mask(M, dtype=mu.dtype) * jnp.outer(nbr_mask[i],nbr_mask[i])  # (j,k)
     cond_energy = nbr_mask[i,:,None,None] * J[None,:,:]  # (j,x_{nbr_j},y_i)
     mean_energy = jnp.einsum ('kx,jk,yx->jy', mu[nbr_idx[i]], nonself_nbr_mask, J)  # (j,y_i)
-    S = S * offdiag_mask(N)
-    return S[None,None,:,:] * jnp.exp(h)[None,None,None,:] * jnp.exp(2*cond_energy)[:,:,None,:] * jnp.exp(2*mean_energy)[:,None,None,:]  # (j,x_{nbr_j},x_i,y_i)
+    return 2*cond_energy, params['h'][None,:] + 2*mean_energy  # (j,x_{nbr_j},y_i), (j,y_i)
 
 # Rate matrix for a single component, q_{xy} = S_{xy}
 # S: (N,N)
 # h: (N,)
 def q_single_offdiag (params):
-    S = params['S']
-    h = params['h']
-    N = S.shape[0]
-    return S * offdiag_mask(N) * jnp.exp(h)[None,:]
+    params = precompute_ctbn_tables (params)
+    return params['S_off'] * params['exp_h'][None,:]
 
 def q_single (params):
     return row_normalise (q_single_offdiag (params))
@@ -151,63 +170,73 @@ def q_single (params):
 def q_joint (nbr_idx, nbr_mask, params):
     N = params['S'].shape[0]
     K,M = nbr_idx.shape
-    def get_components (x):
-        return idx_to_seq (x, N, K)
     def get_rate (xs, ys):
         diffs = jnp.where (xs == ys, 0, 1)
         i = jnp.argmax (diffs)
         return jnp.where (jnp.sum(diffs) == 1, q_k(i, xs, ys[i], nbr_idx, nbr_mask, params), 0)
-    states = jax.vmap (get_components)(jnp.arange(N**K))
+    states = idx_to_seq (jnp.arange(N**K), N, K)  # (N^K,K)
     Q = jax.vmap (lambda x: jax.vmap (lambda y: get_rate(x,y))(states))(states)
     return row_normalise(Q)
 
+# Sequence index <-> (K,) sequence, with component j as the j'th base-N digit. Leading axes of idx/seq are batch axes
 def idx_to_seq (idx, N, K):
-    return jnp.array ([idx // (N**j) % N for j in range(K)])
-                       
+    return (jnp.asarray(idx)[...,None] // (N ** jnp.arange(K))) % N
+
 def seq_to_idx (seq, N):
-    return jnp.sum (jnp.array ([seq[j] * (N**j) for j in range(seq.shape[0])]))
+    return jnp.asarray(seq) @ (N ** jnp.arange(jnp.shape(seq)[-1]))
 
+# Returns (N^K,K) array of all sequences
 def all_seqs (N, K):
-    return [jnp.array(X) for X in np.ndindex(tuple([N]*K))]
+    return idx_to_seq (jnp.arange(N**K), N, K)
 
 # Returns (A,N,N) matrix where entry (k,x_{idx[a]},y_{idx[a]}) is the joint probability of transition x_{idx[a]}->y_{idx[a]} for component idx[a]
+# As with q_bar_and_tilde, a scalar idx gives an (N,N) matrix
 def gamma (idx, nbr_idx, nbr_mask, params, mu, rho):
-    g = jnp.einsum ('ax,axy,ay,ax->axy', mu[idx], q_tilde(idx,nbr_idx,nbr_mask,params,mu), rho[idx], safe_recip(rho[idx]))
-#    jax.debug.print('mu[idx]={mu} qtilde={qt} rho[idx]={rho} g={g}',mu=mu[idx],rho=rho[idx],qt=q_tilde(idx,nbr_idx,nbr_mask,params,mu),g=g)
-    return g
+    return compute_ratemats (idx, nbr_idx, nbr_mask, params, mu, rho)[2]
+
+# Computes q_bar, q_tilde and gamma together, from a single gather of the neighbors' mean-field probabilities
+# Returns a triple of (A,N,N) matrices, or (N,N) matrices for scalar idx
+def compute_ratemats (idx, nbr_idx, nbr_mask, params, mu, rho):
+    qbar, qtilde = q_bar_and_tilde (idx, nbr_idx, nbr_mask, params, mu)
+    g = jnp.einsum ('...x,...xy,...y,...x->...xy', mu[idx], qtilde, rho[idx], safe_recip(rho[idx]))
+#    jax.debug.print('mu[idx]={mu} qtilde={qt} rho[idx]={rho} g={g}',mu=mu[idx],rho=rho[idx],qt=qtilde,g=g)
+    return qbar, qtilde, g
 
 # Returns (N,) vector
+# The (M,N,N,N) conditional rates are never built: the sums over (x_i,y_i) are taken on the factors of
+# q_bar_cond and log(q_tilde_cond), leaving (M,N,N) temporaries
 def psi (i, nbr_idx, nbr_mask, params, mu, rho):
+    params = precompute_ctbn_tables (params)
     gammas = gamma(nbr_idx[i], nbr_idx, nbr_mask, params, mu, rho)  # (M,N,N)
-    qbar_cond = q_bar_cond(i,nbr_idx,nbr_mask,params,mu)  # (M,N,N,N)
-    qtilde_cond = q_tilde_cond(i,nbr_idx,nbr_mask,params,mu)  # (M,N,N,N)
-    log_qtilde_cond = safe_log (jnp.where (qtilde_cond < 0, 1, qtilde_cond))  # (M,N,N,N)
-#    jax.debug.print ("i={i} gammas={g} mu[nbr_idx[i]]={mu} qbar_cond={qb} qtilde_cond={qt} log_qtilde_cond={lq}", i=i, g=gammas, mu=mu[nbr_idx[i]], qb=qbar_cond, qt=qtilde_cond, lq=log_qtilde_cond)
-    return -jnp.einsum('jy,jxyz,j->x',mu[nbr_idx[i]],qbar_cond,nbr_mask[i]) + jnp.einsum('jyz,jxyz,j->x',gammas,log_qtilde_cond,nbr_mask[i])
+    qbar_cond, qbar_rate = q_bar_cond_factors(i,nbr_idx,nbr_mask,params,mu)  # (M,N,N), (M,N)
+    log_qtilde_cond, log_qtilde_rate = q_tilde_cond_log_factors(i,nbr_idx,nbr_mask,params,mu)  # (M,N,N), (M,N)
+    log_S_off = safe_log (jnp.where (params['S_off'] < 0, 1, params['S_off']))  # (N,N)
+    mu_qbar = jnp.einsum('jy,yz->jz',mu[nbr_idx[i]],params['S_off']) * qbar_rate  # (M,N)
+    gamma_in = jnp.einsum('jyz->jz',gammas)  # (M,N)
+#    jax.debug.print ("i={i} gammas={g} mu[nbr_idx[i]]={mu} qbar_cond={qb} log_qtilde_cond={lq}", i=i, g=gammas, mu=mu[nbr_idx[i]], qb=qbar_cond, lq=log_qtilde_cond)
+    return -jnp.einsum('jz,jxz,j->x',mu_qbar,qbar_cond,nbr_mask[i]) + jnp.einsum('jz,jxz,j->x',gamma_in,log_qtilde_cond,nbr_mask[i]) \
+        + jnp.einsum('jyz,yz,j->',gammas,log_S_off,nbr_mask[i]) + jnp.einsum('jz,jz,j->',gamma_in,log_qtilde_rate,nbr_mask[i])
 
 def rho_deriv (i, nbr_idx, nbr_mask, params, mu, rho):
     K = mu.shape[0]
-    qbar = q_bar(jnp.array([i]), nbr_idx, nbr_mask, params, mu)[0,:,:]  # (N,N)
+    qbar, qtilde = q_bar_and_tilde(i, nbr_idx, nbr_mask, params, mu)  # (N,N), (N,N)
     qbar_diag = -jnp.einsum ('xy->x', qbar)  # (N,)
     _psi = psi(i, nbr_idx, nbr_mask, params, mu, rho)  # (N,)
-    qtilde = q_tilde(jnp.array([i]), nbr_idx, nbr_mask, params, mu)  # (1,N,N)
-    rho_deriv_i = -rho[i,:] * (qbar_diag + _psi) - jnp.einsum ('y,xy->x', rho[i,:], qtilde[0,:,:])  # (N,)
+    rho_deriv_i = -rho[i,:] * (qbar_diag + _psi) - jnp.einsum ('y,xy->x', rho[i,:], qtilde)  # (N,)
 #    jax.debug.print ("qbar={qb} qbar_diag={qd} qtilde={qt} psi={psi} rho_deriv={deriv}", qb=qbar, qd=qbar_diag, qt=qtilde, psi=_psi, deriv=rho_deriv_i)
     return rho_deriv_i
 
 def mu_deriv (i, nbr_idx, nbr_mask, params, mu, rho):
     K = mu.shape[0]
-    _gamma = gamma(jnp.array([i]), nbr_idx, nbr_mask, params, mu, rho)[0,:,:]  # (N,N)
+    _gamma = gamma(i, nbr_idx, nbr_mask, params, mu, rho)  # (N,N)
     mu_deriv_i = jnp.einsum('yx->x',_gamma) - jnp.einsum('xy->x',_gamma)  # (N,)
     return mu_deriv_i
 
 def F_deriv (seq_mask, nbr_idx, nbr_mask, params, mu, rho):
     K, N = mu.shape
     idx = jnp.arange(K)
-    qbar = q_bar(idx, nbr_idx, nbr_mask, params, mu)  # (K,N,N)
-    qtilde = q_tilde(idx, nbr_idx, nbr_mask, params, mu)  # (K,N,N)
-    _gamma = gamma (idx, nbr_idx, nbr_mask, params, mu, rho)  # (K,N,N)
-    mask = seq_mask[:,None,None] * offdiag_mask(N)[None,:,:]  # (K,N,N)
+    qbar, qtilde, _gamma = compute_ratemats(idx, nbr_idx, nbr_mask, params, mu, rho)  # (K,N,N), (K,N,N), (K,N,N)
+    mask = seq_mask[:,None,None] * precompute_ctbn_tables(params)['offdiag'][None,:,:]  # (K,N,N)
     log_qtilde = safe_log(jnp.where(mask,qtilde,1))
     gamma_coeff = log_qtilde + 1 + safe_log(mu)[:,:,None] - safe_log(_gamma)
     dF = -jnp.einsum('ix,ixy,ixy->',mu,qbar,mask) + jnp.einsum('ixy,ixy,ixy->',_gamma,gamma_coeff,mask)
@@ -215,19 +244,19 @@ def F_deriv (seq_mask, nbr_idx, nbr_mask, params, mu, rho):
     return dF
 
 # Exact equilibrium distribution for a complete rate matrix
+# Solves eqm.q = 0 with one of the (linearly dependent) balance equations replaced by sum(eqm) = 1.
+# Unlike an eigendecomposition this stays in real arithmetic and works under jit; q must be irreducible
 def exact_eqm (q):
     N = q.shape[0]
-    evals, evecs_r = jnp.linalg.eig(q)
-    evals = jnp.abs(evals)
-    min_eval = jnp.min(evals)  # the eigenvalue closest to zero can be assumed to correspond to the equilibrium
-    min_eval_idx = jnp.where(jnp.isclose(evals,min_eval))[0]
-    assert min_eval_idx.size == 1, f"Can't handle orthogonal equilibria: evals {evals[min_eval_idx]}"
-    evecs_l = jnp.linalg.inv(evecs_r)
-    eqm = jnp.real(evecs_l[min_eval_idx[0],:])
-    eqm /= jnp.sum(eqm)
-    return eqm
+    A = q.T.at[-1,:].set(1)  # (N,N)
+    b = jnp.zeros(N).at[-1].set(1)  # (N,)
+    return jnp.linalg.solve (A, b)
 
 # Exact posterior for a complete rate matrix
+# x and y may be scalars, giving (N,) solutions, or (K,) vectors of endpoints for K independent components, giving (K,N) solutions
+# Solution-like classes are registered as pytrees, so that diffrax and jit see their arrays as dynamic arguments
+# (rather than hashing each new object as a static argument, which forces a recompile per object)
+@jax.tree_util.register_pytree_node_class
 class ExactRho:
     def __init__ (self, q, T, x, y):
         N = q.shape[0]
@@ -237,20 +266,48 @@ class ExactRho:
         self.T = T
         self.x = x
         self.y = y
-        self.exp_qT = expm(q*T) [x, y]
+        self.exp_qT = expm(q*T) [x, y]  # () or (K,)
+        # eigendecomposition q = V diag(evals) V^{-1}, so each evaluate needs only a matrix-vector product rather than an expm
+        # stored as stacked (real,imag) parts, since diffrax warns about complex arrays in its args
+        evals, V = jnp.linalg.eig (self.q)
+        self.evals, self.V, self.V_inv = (jnp.stack ([x.real, x.imag]) for x in (evals, V, jnp.linalg.inv(V)))
+
+    def tree_flatten (self):
+        return (self.q, self.T, self.x, self.y, self.exp_qT, self.evals, self.V, self.V_inv), self.N
+
+    @classmethod
+    def tree_unflatten (cls, N, children):
+        obj = cls.__new__ (cls)
+        obj.N = N
+        obj.q, obj.T, obj.x, obj.y, obj.exp_qT, obj.evals, obj.V, obj.V_inv = children
+        return obj
+
+    def eigensystem (self):
+        return tuple (jax.lax.complex (x[0], x[1]) for x in (self.evals, self.V, self.V_inv))
+
+    # expm(q*s)[:,cols] and expm(q*s)[rows,:]
+    def expm_cols (self, s, cols):
+        evals, V, V_inv = self.eigensystem()
+        return jnp.real (jnp.einsum ('xk,k,k...->...x', V, jnp.exp(evals*s), V_inv[:,cols]))
+
+    def expm_rows (self, s, rows):
+        evals, V, V_inv = self.eigensystem()
+        return jnp.real (jnp.einsum ('...k,k,ky->...y', V[rows,:], jnp.exp(evals*s), V_inv))
 
     def evaluate (self, t):
-        rho = expm(self.q*(self.T-t)) [:, self.y]  # (N,)
+        rho = self.expm_cols (self.T-t, self.y)  # (N,) or (K,N)
         return jnp.minimum(rho,1)
 
+@jax.tree_util.register_pytree_node_class
 class ExactMu (ExactRho):
     def evaluate (self, t):
         rho = super().evaluate (t)
-        exp_qt = expm(self.q*t) [self.x, :]  # (N,)
-        mu = exp_qt * rho / self.exp_qT
-        return mu / jnp.sum(mu)
+        exp_qt = self.expm_rows (t, self.x)  # (N,) or (K,N)
+        mu = exp_qt * rho / jnp.expand_dims(self.exp_qT,-1)
+        return mu / jnp.sum(mu,axis=-1,keepdims=True)
 
 # Dummy class that returns fixed solution for mu and/or rho
+@jax.tree_util.register_pytree_node_class
 class FixedSolution():
     def __init__ (self, val):
         self.val = val
@@ -258,25 +315,98 @@ class FixedSolution():
     def evaluate (self, t):
         return self.val
 
+    def tree_flatten (self):
+        return (self.val,), None
+
+    @classmethod
+    def tree_unflatten (cls, _aux, children):
+        obj = cls.__new__ (cls)
+        obj.val, = children
+        return obj
+
+@jax.tree_util.register_pytree_node_class
 class ZeroSolution(FixedSolution):
     def __init__ (self, N):
         super().__init__ (jnp.zeros(N))
 
-# helper to evaluate mu and rho from arrays of Solution-like objects
-def eval_mu_rho (mu_solns, rho_solns, t):
-    mu = jnp.stack ([mu_soln.evaluate(t) for mu_soln in mu_solns])
-    rho = jnp.stack ([rho_soln.evaluate(t) for rho_soln in rho_solns])
+# Fixed-step solution from rk4_solve, with linear interpolation between the grid points in place of diffrax's dense output
+# ts: (n,) increasing times, ys: (n,N) states
+@jax.tree_util.register_pytree_node_class
+class RK4Solution:
+    def __init__ (self, ts, ys):
+        self.ts = ts
+        self.ys = ys
+
+    def evaluate (self, t):
+        return jax.vmap (lambda y: jnp.interp (t, self.ts, y), in_axes=1) (self.ys)  # (N,)
+
+    def tree_flatten (self):
+        return (self.ts, self.ys), None
+
+    @classmethod
+    def tree_unflatten (cls, _aux, children):
+        obj = cls.__new__ (cls)
+        obj.ts, obj.ys = children
+        return obj
+
+# Classical 4th-order Runge-Kutta over a fixed grid of times ts (increasing or decreasing), as a single lax.scan
+# term_fn has the diffrax ODETerm signature (t, y, args). Returns an RK4Solution
+def rk4_solve (term_fn, y0, ts, args):
+    def step (y, t_pair):
+        t, t_next = t_pair
+        dt = t_next - t
+        k1 = term_fn (t, y, args)
+        k2 = term_fn (t + dt/2, y + k1*dt/2, args)
+        k3 = term_fn (t + dt/2, y + k2*dt/2, args)
+        k4 = term_fn (t_next, y + k3*dt, args)
+        y_next = y + (k1 + 2*k2 + 2*k3 + k4) * dt/6
+        return y_next, y_next
+    _y_last, ys = jax.lax.scan (step, y0, (ts[:-1], ts[1:]))
+    ys = jnp.concatenate ([y0[None,:], ys])  # (n,N)
+    decreasing = ts[0] > ts[-1]  # RK4Solution.evaluate needs increasing times
+    return RK4Solution (jnp.where (decreasing, ts[::-1], ts), jnp.where (decreasing, ys[::-1], ys))
+
+# Fixed grid of n_steps+1 times from 0 to T (n_steps even), log-spaced in the distance to the nearer endpoint.
+# mu and rho change fastest close to the endpoints they are conditioned on, so the steps shrink geometrically towards 0 and T
+def rk4_grid (T, n_steps, min_frac=1e-3):
+    assert n_steps % 2 == 0, "n_steps must be even"
+    half = (jnp.geomspace (min_frac, 1, n_steps//2 + 1) - min_frac) / (1 - min_frac) * T/2  # (n_steps/2+1,) from 0 up to T/2
+    return jnp.concatenate ([half, T - half[-2::-1]])  # (n_steps+1,)
+
+# helper to evaluate mu and rho from lists of Solution-like objects, from stacked diffrax Solution's,
+# or from a single Solution-like object covering all components (e.g. ExactRho with vector endpoints)
+def eval_solns (solns, t):
+    if isinstance (solns, (list, tuple)):
+        return jnp.stack ([soln.evaluate(t) for soln in solns])
+    if isinstance (solns, (diffrax.Solution, RK4Solution)):
+        return jax.vmap (lambda soln: soln.evaluate(t)) (solns)
+    return solns.evaluate(t)
+
+def eval_mu_rho (mu_solns, rho_solns, t, dtype=None):
+    mu, rho = eval_solns (mu_solns, t), eval_solns (rho_solns, t)
+    if dtype is not None:
+        mu, rho = mu.astype(dtype), rho.astype(dtype)
     return mu, rho
 
+# Cast params (including precomputed tables) to a reduced-precision dtype, e.g. jnp.bfloat16, for evaluating ODE right-hand sides.
+# dtype=None leaves them unchanged
+def cast_ctbn_params (params, dtype):
+    if dtype is None:
+        return params
+    return jax.tree_util.tree_map (lambda x: x.astype(dtype), params)
+
 # wrappers for diffrax
+# The right-hand sides are evaluated in the dtype of params (see rhs_dtype below), and the derivative is cast back
+# to the dtype of the ODE state, which the integrator keeps in full precision
 def F_term (t, F_t, args):
     seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T = args
-    mu, rho = eval_mu_rho (mu_solns, rho_solns, t)
+    mu, rho = eval_mu_rho (mu_solns, rho_solns, t, dtype=params['exp_h'].dtype)
     mu = jnp.where (t < T, mu, rho)  # guard against explosion at boundary
 #    jax.debug.print ("t={t} mu={mu} rho={rho} dF={deriv}", t=t, mu=mu, rho=rho, deriv=F_deriv (seq_mask, nbr_idx, nbr_mask, params, mu, rho))
-    return F_deriv (seq_mask, nbr_idx, nbr_mask, params, mu, rho)
+    return F_deriv (seq_mask, nbr_idx, nbr_mask, params, mu, rho).astype(F_t.dtype)
 
-def solve_F (seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6):
+def solve_F (seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6, rhs_dtype=None):
+    params = cast_ctbn_params (precompute_ctbn_tables (params), rhs_dtype)  # build the tables once, not at every solver step
     term = diffrax.ODETerm (F_term)
     solver = diffrax.Dopri5()
     controller = diffrax.PIDController (rtol=rtol, atol=atol)
@@ -287,43 +417,57 @@ def solve_F (seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1
 
 def rho_term (t, rho_i_t, args):
     i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T = args
-    mu, rho = eval_mu_rho (mu_solns, rho_solns, t)
+    mu, rho = eval_mu_rho (mu_solns, rho_solns, t, dtype=params['exp_h'].dtype)
     mu = jnp.where (t < T, mu, rho)  # guard against explosion at boundary
     old_rho_i_t = rho[i,:]
-    rho = rho.at[i].set(rho_i_t)
+    rho = rho.at[i].set(rho_i_t.astype(rho.dtype))
     _rho_deriv = rho_deriv (i, nbr_idx, nbr_mask, params, mu, rho)
 #    jax.debug.print ("t={t} old_rho[{i}]={old} new_rho[{i}]={new} deriv={deriv}\n mu={mu}\n rho={rho}", t=t, mu=mu, rho=rho, deriv=_rho_deriv, old=old_rho_i_t, new=rho_i_t, i=i)
-    return seq_mask[i] * _rho_deriv
-
-def solve_rho (i, rho_i_T, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6):
+    return (seq_mask[i] * _rho_deriv).astype(rho_i_t.dtype)
+
+# If fast_mode=True, the adaptive Dopri5 solve is replaced by rk4_solve on the n_steps rk4_grid
+def solve_rho (i, rho_i_T, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6, rhs_dtype=None, fast_mode=False, n_steps=128):
+    params = cast_ctbn_params (precompute_ctbn_tables (params), rhs_dtype)  # build the tables once, not at every solver step
+    args = (i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T)
+    if fast_mode:
+        return rk4_solve (rho_term, rho_i_T, rk4_grid (T, n_steps)[::-1], args)
     term = diffrax.ODETerm (rho_term)
     solver = diffrax.Dopri5()
     controller = diffrax.PIDController (rtol=rtol, atol=atol)
     return diffrax.diffeqsolve (terms=term, solver=solver, t0=T, t1=0, dt0=None, y0 = rho_i_T,
-                                args=(i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T),
+                                args=args,
                                 stepsize_controller = controller,
                                 saveat = diffrax.SaveAt(dense=True))
 
 def mu_term (t, mu_i_t, args):
     i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T = args
-    mu, rho = eval_mu_rho (mu_solns, rho_solns, t)
-    mu = mu.at[i].set(mu_i_t)
+    mu, rho = eval_mu_rho (mu_solns, rho_solns, t, dtype=params['exp_h'].dtype)
+    mu = mu.at[i].set(mu_i_t.astype(mu.dtype))
     mu = jnp.where (t < T, mu, rho)  # guard against explosion at boundary
-#    jax.debug.print ("t={t} mu={mu} rho={rho} gamma={g} deriv={deriv}", t=t, mu=mu, rho=rho, deriv=mu_deriv (i, nbr_idx, nbr_mask, params, mu, rho), g=gamma(jnp.array([i]), nbr_idx, nbr_mask, params, mu, rho)[0,:,:])
-    return seq_mask[i] * mu_deriv (i, nbr_idx, nbr_mask, params, mu, rho)
-
-def solve_mu (i, mu_i_0, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6):
+#    jax.debug.print ("t={t} mu={mu} rho={rho} gamma={g} deriv={deriv}", t=t, mu=mu, rho=rho, deriv=mu_deriv (i, nbr_idx, nbr_mask, params, mu, rho), g=gamma(i, nbr_idx, nbr_mask, params, mu, rho))
+    return (seq_mask[i] * mu_deriv (i, nbr_idx, nbr_mask, params, mu, rho)).astype(mu_i_t.dtype)
+
+def solve_mu (i, mu_i_0, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rtol=1e-3, atol=1e-6, rhs_dtype=None, fast_mode=False, n_steps=128):
+    params = cast_ctbn_params (precompute_ctbn_tables (params), rhs_dtype)  # build the tables once, not at every solver step
+    args = (i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T)
+    if fast_mode:
+        return rk4_solve (mu_term, mu_i_0, rk4_grid (T, n_steps), args)
     term = diffrax.ODETerm (mu_term)
     solver = diffrax.Dopri5()
     controller = diffrax.PIDController (rtol=rtol, atol=atol)
     return diffrax.diffeqsolve (terms=term, solver=solver, t0=0, t1=T, dt0=None, y0=mu_i_0,
-                                args=(i, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T),
+                                args=args,
                                 stepsize_controller = controller,
                                 saveat = diffrax.SaveAt(dense=True))
 
 # Calculate the variational likelihood for an endpoint-conditioned continuous-time Bayesian network
 # This is a strict lower bound for log P(X_T=ys|X_0=xs,T,params)
-def ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params, T, min_inc=1e-3, max_updates=4096):
+# If jacobi=True, each sweep solves all components in parallel (vmapped) against the previous sweep's solutions,
+# instead of one at a time in random order. Each sweep is faster but convergence per sweep is slower
+# If rhs_dtype is given (e.g. jnp.bfloat16), the right-hand sides of the mu and rho ODEs are evaluated in that precision.
+# The bound F itself is always integrated in full precision, since it drives the convergence test
+# If fast_mode=True, the mu and rho ODEs are solved by fixed-step RK4 (see solve_rho) rather than adaptive Dopri5
+def ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params, T, min_inc=1e-3, max_updates=4096, jacobi=False, rhs_dtype=None, fast_mode=False):
     K = nbr_idx.shape[0]
     N = params['S'].shape[0]
     params = normalise_ctbn_params (params)
@@ -332,11 +476,17 @@ def ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params
     rho_T = jnp.eye(N)[ys]
     # create initial mu, rho solutions by assuming no interactions
     q1 = q_single (params)
-    init_rho_solns = [ExactRho (q1, T, xs[i], ys[i]) for i in range(K)]
-    init_mu_solns = [ExactMu (q1, T, xs[i], ys[i]) for i in range(K)]
+    init_rho_solns = ExactRho (q1, T, xs, ys)  # all K components at once, sharing one expm(q1*T)
+    init_mu_solns = ExactMu (q1, T, xs, ys)
     # do one update so (rho_solns,mu_solns) are diffrax AbstractPath's, to keep types uniform inside while loop
-    rho_solns = [solve_rho (i, rho_T[i,:], seq_mask, nbr_idx, nbr_mask, params, init_mu_solns, init_rho_solns, T) for i in range(K)]
-    mu_solns = [solve_mu (i, mu_0[i,:], seq_mask, nbr_idx, nbr_mask, params, init_mu_solns, rho_solns, T) for i in range(K)]
+    # the diffrax Solution's are kept stacked along a leading (K,) axis, so the loop state is a single pytree
+    # each component's solve depends only on the previous solutions, so a whole sweep can be vmapped over components
+    def solve_all_rho (mu_solns, rho_solns):
+        return jax.vmap (lambda i, rho_i_T: solve_rho (i, rho_i_T, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rhs_dtype=rhs_dtype, fast_mode=fast_mode)) (jnp.arange(K), rho_T)
+    def solve_all_mu (mu_solns, rho_solns):
+        return jax.vmap (lambda i, mu_i_0: solve_mu (i, mu_i_0, seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rhs_dtype=rhs_dtype, fast_mode=fast_mode)) (jnp.arange(K), mu_0)
+    rho_solns = solve_all_rho (init_mu_solns, init_rho_solns)
+    mu_solns = solve_all_mu (init_mu_solns, rho_solns)
     # while (F_current - F_prev)/F_prev > minimum relative increase:
     #  for component indices i, in (nonrepeating) random order:
     #   solve rho and then mu for component i, using diffrax, and replace single-component posteriors with diffrax Solution's
@@ -348,6 +498,11 @@ def ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params
         return F
     def update_fun (outer_state):
         inner_state, last_i = outer_state
+        if jacobi:
+            mu_solns, rho_solns = inner_state
+            rho_solns = solve_all_rho (mu_solns, rho_solns)
+            mu_solns = solve_all_mu (mu_solns, rho_solns)
+            return (mu_solns, rho_solns), last_i
         order = jax.random.permutation (prng, K)
         order = jax.lax.cond (last_i == order[0], lambda x:order[::-1], lambda x:order, None)  # avoid repetition
 #        jax.debug.print("order={order}",order=order)
@@ -355,13 +510,13 @@ def ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params
         return inner_state, order[-1]
     def loop_body_fun (inner_state, i):
         mu_solns, rho_solns = inner_state
-        new_rho_i = solve_rho (i, rho_T[i,:], seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T)
+        new_rho_i = solve_rho (i, rho_T[i,:], seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rhs_dtype=rhs_dtype, fast_mode=fast_mode)
         rho_solns = replace_nth (rho_solns, i, new_rho_i)
-        new_mu_i = solve_mu (i, mu_0[i,:], seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T)
+        new_mu_i = solve_mu (i, mu_0[i,:], seq_mask, nbr_idx, nbr_mask, params, mu_solns, rho_solns, T, rhs_dtype=rhs_dtype, fast_mode=fast_mode)
         mu_solns = replace_nth (mu_solns, i, new_mu_i)
         return (mu_solns, rho_solns), None
-    log_elbo, (mu_rho, _last_i)  = bounded_optimize(score_fun, update_fun, ((mu_solns, rho_solns), -1), max_updates, min_inc=min_inc)
-    return log_elbo, mu_rho
+    log_elbo, ((mu_solns, rho_solns), _last_i)  = bounded_optimize(score_fun, update_fun, ((mu_solns, rho_solns), -1), max_updates, min_inc=min_inc)
+    return log_elbo, (unstack_pytrees(mu_solns,K), unstack_pytrees(rho_solns,K))
 
 # Given sequences xs,ys and contact matrix C, return padded xs,ys along with seq_mask,nbr_idx,nbr_mask
 def get_Markov_blankets (C, xs=None, ys=None, K=None, M=None):
@@ -373,15 +528,20 @@ def get_Markov_blankets (C, xs=None, ys=None, K=None, M=None):
         assert len(ys) == K_prepad, "length of ys must equal size of C"
     if K is None:
         K = round_up_to_power (K_prepad)
-    nbr_idx_list = [C[i,:].nonzero()[0] for i in range(K_prepad)]
+    is_nbr = np.asarray(C) != 0  # (K_prepad,K_prepad)
+    n_nbrs = int (np.max (np.sum (is_nbr, axis=1), initial=0))
     if M is None:
-        M = round_up_to_power (max ([len(nbr_idx) for nbr_idx in nbr_idx_list]))
+        M = round_up_to_power (n_nbrs)
     else:
-        assert M >= max ([len(nbr_idx) for nbr_idx in nbr_idx_list]), "M must be at least as large as the largest number of neighbors"
+        assert M >= n_nbrs, "M must be at least as large as the largest number of neighbors"
     seq_idx = jnp.arange(K)
     seq_mask = jnp.where(seq_idx < K_prepad, 1, 0)
-    nbr_mask = jnp.array ([[1] * len(nbr_idx) + [0] * (M - len(nbr_idx)) for nbr_idx in nbr_idx_list] + [[0] * M] * (K - K_prepad))
-    nbr_idx = jnp.array ([jnp.concatenate([nbrs,jnp.zeros(M - len(nbrs),dtype=nbrs.dtype)]) for nbrs in nbr_idx_list])
+    # pad to K rows (padding sequences have no neighbors) and at least M columns, then move each row's neighbors to the front in index order
+    is_nbr = np.pad (is_nbr, ((0,K-K_prepad),(0,max(M-K_prepad,0))))  # (K,max(K_prepad,M))
+    sorted_idx = np.argsort (~is_nbr, axis=1, kind='stable')[:,:M]  # (K,M)
+    sorted_mask = np.take_along_axis (is_nbr, sorted_idx, axis=1)  # (K,M)
+    nbr_mask = jnp.array (sorted_mask, dtype=jnp.int32)
+    nbr_idx = jnp.array (np.where (sorted_mask, sorted_idx, 0), dtype=jnp.int32)
     if xs is not None:
         xs = xs + [0] * (K - K_prepad)
     if ys is not None:
@@ -398,8 +558,7 @@ def ctbn_pseudo_log_marg (xs, seq_mask, nbr_idx, nbr_mask, params):
     N = params['S'].shape[0]
     params = normalise_ctbn_params (params)
     E_iy = params['h'][None,:] + jnp.einsum('ijy,ij->iy',params['J'][nbr_idx,:],nbr_mask)  # (K,N)
-    log_Zi = logsumexp (E_iy, axis=-1)  # (K,)
-    L_i = E_iy[jnp.arange(K),xs] - log_Zi  # (K,N)
+    L_i = E_iy[jnp.arange(K),xs] - logsumexp (E_iy, axis=-1)  # (K,)
     return jnp.sum (L_i * seq_mask)
 
 # Mean-field approximation to log partition function of continuous-time Bayesian network
@@ -413,11 +572,13 @@ def ctbn_variational_log_Z (seq_mask, nbr_idx, nbr_mask, params, min_inc=1e-3, m
     K = nbr_idx.shape[0]
     N = params['S'].shape[0]
     params = normalise_ctbn_params (params)
-    theta = jnp.repeat (jax.nn.softmax (params['h'])[None,:], K, axis=0)  # (K,N)
+    theta = jnp.broadcast_to (jax.nn.softmax (params['h']), (K,N))  # (K,N)
     def score_fun (theta):
         return ctbn_mean_field_log_Z (seq_mask, nbr_idx, nbr_mask, params, theta)
     def update_fun (theta):
-        return jax.nn.softmax (params['h'][None,:] + 2 * jnp.einsum('ijy,xy,ij->ix',theta[nbr_idx,:],params['J'],nbr_mask))
+        # sum the neighbors' marginals first, then contract with J as a single (K,N)x(N,N) matmul
+        msg = jnp.einsum('ijy,ij->iy',theta[nbr_idx,:],nbr_mask)  # (K,N)
+        return jax.nn.softmax (params['h'][None,:] + 2 * msg @ params['J'].T)
     return bounded_optimize(score_fun, update_fun, theta, max_updates, min_inc=min_inc)
 
 # Unnormalized log-marginal for a continuous-time Bayesian network
@@ -425,7 +586,7 @@ def ctbn_log_marg_unnorm (xs, seq_mask, nbr_idx, nbr_mask, params):
     K, M = nbr_idx.shape
     N = params['S'].shape[0]
     params = normalise_ctbn_params (params)
-    E_i = params['h'][xs] + jnp.einsum('ij,ij->i',params['J'][jnp.repeat(xs[:,None],M,axis=-1),xs[nbr_idx]],nbr_mask)  # (K,)
+    E_i = params['h'][xs] + jnp.einsum('ij,ij->i',params['J'][xs[:,None],xs[nbr_idx]],nbr_mask)  # (K,)
     return jnp.sum (E_i * seq_mask)
 
 # Variational log-marginal for a continuous-time Bayesian network
@@ -436,14 +597,44 @@ def ctbn_variational_log_marg (xs, seq_mask, nbr_idx, nbr_mask, params, log_Z =
     return log_p - log_Z
 
 # Exact log-partition function for a continuous-time Bayesian network
+# The Potts model factorizes into one exp(h) vector per component and one exp(J) matrix per (directed) neighbor pair,
+# so Z is a tensor network contraction whose cost is exponential only in the treewidth of the contact graph.
+# We let opt_einsum choose the pairwise contraction order, then contract step by step, rescaling each intermediate
+# so that it stays within float32 range.
+# The contact graph (seq_mask, nbr_idx, nbr_mask) must be concrete, i.e. not traced
 def ctbn_exact_log_Z (seq_mask, nbr_idx, nbr_mask, params):
+    params = normalise_ctbn_params (params)
+    h = params['h']
+    J = params['J']
+    seq_mask, nbr_idx, nbr_mask = np.asarray(seq_mask), np.asarray(nbr_idx), np.asarray(nbr_mask)
+    components = [i for i in range(seq_mask.shape[0]) if seq_mask[i]]
+    edges = [(i, int(j)) for i in components for j, m in zip(nbr_idx[i], nbr_mask[i]) if m]
+    if len(components) == 0:
+        return jnp.zeros(())
+    max_h = jnp.max (h)
+    max_J = jnp.max (J)
+    factors = [(jnp.exp (h - max_h), (i,)) for i in components] + [(jnp.exp (J - max_J), (i,j)) for i, j in edges]
+    path, _info = opt_einsum.contract_path (*[x for f in factors for x in f], (), optimize='auto-hq')
+    log_Z = len(components) * max_h + len(edges) * max_J
+    for step in path:
+        operands = [factors.pop(n) for n in sorted(step, reverse=True)]
+        remaining_legs = set (leg for _f, legs in factors for leg in legs)
+        legs = tuple (sorted (set (leg for _f, f_legs in operands for leg in f_legs) & remaining_legs))
+        f = jnp.einsum (*[x for op, op_legs in operands for x in (op, op_legs)], legs)
+        scale = jnp.max (f)
+        factors.append ((f / scale, legs))
+        log_Z = log_Z + jnp.log (scale)
+    return log_Z
+
+# Exact log-partition function by brute-force enumeration of all N^K sequences
+def ctbn_brute_force_log_Z (seq_mask, nbr_idx, nbr_mask, params):
     K = nbr_idx.shape[0]
     N = params['S'].shape[0]
     params = normalise_ctbn_params (params)
-    Xs = all_seqs(N,K)
-    X_is_valid = jnp.array ([jnp.all(seq_mask * X == X) for X in Xs])
-    Es = jnp.array ([ctbn_log_marg_unnorm(X,seq_mask,nbr_idx,nbr_mask,params) for X in Xs])
-    return logsumexp(jnp.where(X_is_valid,Es,-jnp.inf)).item()
+    Xs = all_seqs(N,K)  # (N^K,K)
+    X_is_valid = jnp.all(seq_mask[None,:] * Xs == Xs, axis=-1)  # (N^K,)
+    Es = jax.vmap (ctbn_log_marg_unnorm, in_axes=(0,None,None,None,None)) (Xs, seq_mask, nbr_idx, nbr_mask, params)  # (N^K,)
+    return logsumexp(jnp.where(X_is_valid,Es,-jnp.inf))
 
 # Exact log-marginal for a continuous-time Bayesian network
 def ctbn_exact_log_marg (xs, seq_mask, nbr_idx, nbr_mask, params, log_Z = None):
@@ -58,6 +58,19 @@ class TestCTBN (unittest.TestCase):
         logZ_variational, theta = ctbn.ctbn_variational_log_Z(seq_mask, nbr_idx, nbr_mask, params)
         self.assertTrue (jnp.all(logZ_exact > logZ_variational))
 
+    # On a contact graph with cycles, contracting the factor graph should give the same partition function as enumerating all sequences
+    def test_loopy_partition (self):
+        N, K = 3, 4
+        C = jnp.zeros((K,K))
+        for i, j in [(0,1), (1,2), (2,3), (3,0), (0,2)]:
+            C = C.at[i,j].set(1).at[j,i].set(1)
+        J_key, h_key = jax.random.split (jax.random.PRNGKey(42))
+        params = { 'S': jnp.ones((N,N)), 'J': jax.random.normal(J_key,(N,N)), 'h': jax.random.normal(h_key,(N,)) }
+        seq_mask, nbr_idx, nbr_mask, *_rest = ctbn.get_Markov_blankets(C)
+        logZ_exact = ctbn.ctbn_exact_log_Z(seq_mask, nbr_idx, nbr_mask, params)
+        logZ_brute_force = ctbn.ctbn_brute_force_log_Z(seq_mask, nbr_idx, nbr_mask, params)
+        self.assertTrue (jnp.allclose(logZ_exact, logZ_brute_force))
+
     # For a single component, the log-pseudolikelihood should be equal to the log-likelihood
     def test_telegraph1_pseudo (self):
         self.do_test_telegraph_pseudo ([0])
@@ -123,7 +136,7 @@ class TestCTBN (unittest.TestCase):
     def test_telegraph1_variational (self):
         self.do_test_telegraph_variational ([0], [1], 1.0)
     
-    def do_test_telegraph_variational (self, xs, ys, T):
+    def do_test_telegraph_variational (self, xs, ys, T, **kwargs):
         N = 2
         K = len(xs)
         C, params = telegraph(K=K)
@@ -135,7 +148,7 @@ class TestCTBN (unittest.TestCase):
         q_joint = ctbn.q_joint(nbr_idx, nbr_mask, params)
         ll_exact = jnp.log(expm(T * q_joint)[xidx, yidx])
         prng = jax.random.PRNGKey(42)
-        log_elbo, (mu_elbo, rho_elbo) = ctbn.ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params, T)
+        log_elbo, (mu_elbo, rho_elbo) = ctbn.ctbn_variational_log_cond (prng, xs, ys, seq_mask, nbr_idx, nbr_mask, params, T, **kwargs)
         self.assertTrue (jnp.allclose(log_elbo, ll_exact, rtol=1e-2, atol=1e-1))
         q1 = ctbn.q_single (params)
         for k in range(K):
@@ -148,6 +161,14 @@ class TestCTBN (unittest.TestCase):
     def test_telegraph2_variational (self):
         self.do_test_telegraph_variational ([0,0], [1,1], 1.0)
 
+    # Same, but updating both components in parallel sweeps
+    def test_telegraph2_variational_jacobi (self):
+        self.do_test_telegraph_variational ([0,0], [1,1], 1.0, jacobi=True)
+
+    # Same, but with fixed-step RK4 in place of the adaptive ODE solver
+    def test_telegraph2_variational_fast (self):
+        self.do_test_telegraph_variational ([0,0], [1,1], 1.0, fast_mode=True)
+
     # For two components that are in contact, F should be a reasonably close lower bound for the log-likelihood
     def test_ising2_variational (self):
         self.do_test_ising2_variational ([0,1], [1,0], 1.0)
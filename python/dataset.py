@@ -1,4 +1,5 @@
 import os
+import math
 import glob
 
 import jax
@@ -46,7 +47,7 @@ def createLossFunction (dataset, model_factory, includeSubs = True, includeIndel
     def loss (params):
         subRate, rootProb, indelParams, alnTypeWeight, colTypeWeight, colQuantiles = model_factory (params)
         alphabetSize = subRate.shape[-1]
-        logQuantiles = jnp.log(len(colQuantiles))
+        logQuantiles = math.log(len(colQuantiles))
         colTypeLogWeight = jnp.log(colTypeWeight)
         alnTypeLogWeight = jnp.log(alnTypeWeight)
         l_total = 0.
@@ -60,7 +61,7 @@ def createLossFunction (dataset, model_factory, includeSubs = True, includeIndel
             else:
                 sub_ll = 0.
             if includeIndels:
-                trans_ll = jnp.array ([jnp.sum (likelihood.transLogLike (transCounts, distanceToParent, p, alphabetSize=alphabetSize, useKM03=useKM03)) for p in indelParams])  # (nAlignTypes,)
+                trans_ll = jax.vmap (lambda p: jnp.sum (likelihood.transLogLike (transCounts, distanceToParent, p, alphabetSize=alphabetSize, useKM03=useKM03))) (indelParams)  # (nAlignTypes,)
             else:
                 trans_ll = 0.
             l_total -= logsumexp(alnTypeLogWeight + trans_ll + sub_ll)
@@ -52,9 +52,18 @@ def logTransMat (transMat):
 def logRootTransMat():
     return logTransMat (h20.dummyRootTransitionMatrix())
 
+# Indel transition matrix under H20 or KM03.
+# A Python bool useKM03 picks the model at trace time; an array-valued (e.g. traced) useKM03 dispatches via lax.switch,
+# so one compiled function serves both models
+def transitionMatrix (t, indelParams, alphabetSize=20, useKM03=False):
+    if isinstance (useKM03, bool):
+        return (km03.transitionMatrix if useKM03 else h20.transitionMatrix) (t, indelParams, alphabetSize=alphabetSize)
+    branches = [lambda t, p: h20.transitionMatrix (t, p, alphabetSize=alphabetSize),
+                lambda t, p: km03.transitionMatrix (t, p)]
+    return jax.lax.switch (jnp.asarray(useKM03).astype(jnp.int32), branches, t, indelParams)
+
 def computeTransMatForTimes (ts, indelParams, alphabetSize=20, useKM03=False):
-    transitionMatrix = km03.transitionMatrix if useKM03 else h20.transitionMatrix
-    branches = jnp.stack ([transitionMatrix(t,indelParams,alphabetSize=alphabetSize) for t in ts[1:]], axis=0)
+    branches = jax.vmap (lambda t: transitionMatrix(t,indelParams,alphabetSize=alphabetSize,useKM03=useKM03)) (ts[1:])  # (R-1,3,3)
     return jnp.concatenate ([logRootTransMat()[None,:,:], logTransMat(branches)], axis=0)
 
 def transLogLikeForTransMats (transCounts, transMats):
@@ -186,7 +195,7 @@ def createGGIModelFactory (subModelFactory, nQuantiles):
         subRate = jnp.einsum ('cij,qc->qcij', subRate, colQuantiles)  # (nQuantiles,nColTypes,A,A)
         rootProb = jnp.stack([m[1] for m in mixture], axis=0)  # (nColTypes,A)
         rootProb = jnp.repeat (rootProb[None,:,:], nQuantiles, axis=0)  # (nQuantiles,nColTypes,A)
-        indelParams = [parametricIndelModel(*p) for p in params['indels']]  # (nAlignTypes,4)
+        indelParams = jnp.stack ([parametricIndelModel(*p) for p in params['indels']], axis=0)  # (nAlignTypes,4)
         alnTypeWeight = logitsToProbs(params['alntypelogits'])  # (nAlignTypes,)
         colTypeWeight = logitsToProbs(params['coltypelogits'])  # (nAlignTypes,nColTypes)
         return subRate, rootProb, indelParams, alnTypeWeight, colTypeWeight, colQuantiles
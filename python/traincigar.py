@@ -35,6 +35,8 @@ def main (modelFile: str,
           use_jit: bool = True,
           cherry: bool = False,
           phylocherry: bool = False,
+          n_jobs: int = 1,
+          bf16_after: int = None,
           ):
     """
     Compute derivatives of log-likelihood for tree, alignment, and model.
@@ -57,6 +59,8 @@ def main (modelFile: str,
         use_jit: Use JIT compilation
         cherry: use CherryML-style composite likelihood for training
         phylocherry: use phylogenetically weighted composite likelihood to train column-level mixtures
+        n_jobs: number of worker processes for preprocessing alignments (cherry and phylocherry only)
+        bf16_after: evaluate substitution loss in bfloat16 from this EM step onwards (cherry and phylocherry only)
     """
 
     # Read model and alphabet
@@ -107,9 +111,9 @@ def main (modelFile: str,
         opt_args = {'init_lr':init_lr, 'max_iter':max_iter, 'min_inc':min_inc, 'patience':patience, 'show_grads':show_grads}
         assert not (cherry and phylocherry), "Cannot use both CherryML and phylogenetic CherryML"
         if phylocherry:
-            best_params, best_ll = optimizeByPhyloExpectationCompositeMaximization (data, ggi_model_factory, params, use_jit=use_jit, useKM03=km03, **opt_args)
+            best_params, best_ll = optimizeByPhyloExpectationCompositeMaximization (data, ggi_model_factory, params, use_jit=use_jit, useKM03=km03, n_jobs=n_jobs, bf16_after=bf16_after, **opt_args)
         elif cherry:
-            best_params, best_ll = optimizeByCompositeExpectationMaximization (data, ggi_model_factory, params, use_jit=use_jit, useKM03=km03, **opt_args)
+            best_params, best_ll = optimizeByCompositeExpectationMaximization (data, ggi_model_factory, params, use_jit=use_jit, useKM03=km03, n_jobs=n_jobs, bf16_after=bf16_after, **opt_args)
         else:
             best_params, best_ll = optimize (jit (jax.value_and_grad (loss)), params, **opt_args)
 